@@ -6,7 +6,8 @@
 
 from trytond.pool import Pool
 from channel import (
-    Channel, PrestashopExportOrdersWizardView, PrestashopConnectionWizardView,
+    Channel, ChannelException, PrestashopExportOrdersWizardView,
+    PrestashopConnectionWizardView,
     PrestashopExportOrdersWizard, PrestashopConnectionWizard
 )
 from country import (
@@ -15,14 +16,18 @@ from country import (
 from currency import CurrencyPrestashop, Currency
 from party import Party, Address, ContactMechanism
 from product import Product, ProductSaleChannelListing
-from sale import Sale, SaleLine
+from sale import Sale, SaleLine, Move, ShipmentOut
 from lang import Language, SiteLanguage
+from cache import HTTPCache
+from job import ImportJob
+from outbox import OrderStateOutbox
 
 
 def register():
     "Register classes with pool"
     Pool.register(
         Channel,
+        ChannelException,
         PrestashopExportOrdersWizardView,
         PrestashopConnectionWizardView,
         Country,
@@ -39,7 +44,12 @@ def register():
         Product,
         Sale,
         SaleLine,
+        Move,
+        ShipmentOut,
         ProductSaleChannelListing,
+        HTTPCache,
+        ImportJob,
+        OrderStateOutbox,
         module='prestashop', type_='model')
     Pool.register(
         PrestashopExportOrdersWizard,
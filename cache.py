@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+    cache
+
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sql import Literal
+from sql.aggregate import Count
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+
+__all__ = ['HTTPCache']
+logger = logging.getLogger(__name__)
+
+#: Seconds during which the last access time of a response is not updated
+#: again. The order of the least recently used responses only needs to be
+#: rough.
+TOUCH_INTERVAL = 10 * 60
+
+
+class HTTPCache(ModelSQL):
+    """Prestashop webservice response cache
+
+    This model keeps the responses of the prestashop resources which rarely
+    change, like countries, currencies and languages, along with the
+    validators (ETag and Last-Modified) sent by the site.
+    A response younger than the max age of the channel is used without
+    asking the site. Older responses are revalidated with a conditional
+    request, and used as is if the site answers that they did not change.
+    The least recently used responses are dropped when the cache of a
+    channel grows beyond its size.
+    """
+    __name__ = 'prestashop.http.cache'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    url = fields.Char('URL', required=True, select=True)
+    etag = fields.Char('ETag')
+    last_modified = fields.Char('Last Modified')
+    content = fields.Binary('Content')
+    fetched_at = fields.DateTime('Fetched At', required=True)
+    last_access = fields.DateTime('Last Access', required=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(HTTPCache, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'channel_url_uniq', 'UNIQUE(channel, url)',
+                'Cached response must be unique by channel and URL'
+            )
+        ]
+
+    @classmethod
+    def lookup(cls, channel, url):
+        """
+        Return the cached response for the url. The response is not marked
+        as used, see `touch`.
+
+        :param channel: Active record of the channel
+        :param url: URL of the request including the query string
+        :returns: Active record of the cached response or None
+        """
+        entries = cls.search([
+            ('channel', '=', channel.id),
+            ('url', '=', url),
+        ])
+        if not entries:
+            return None
+
+        entry, = entries
+        return entry
+
+    def needs_touch(self):
+        """
+        Check if the last access time of the response was not updated for
+        a while
+        """
+        return datetime.utcnow() - self.last_access >= timedelta(
+            seconds=TOUCH_INTERVAL
+        )
+
+    @classmethod
+    def touch(cls, entries):
+        """
+        Update the last access time of the entries at once
+        """
+        if entries:
+            cls.write(entries, {'last_access': datetime.utcnow()})
+
+    def is_fresh(self, max_age):
+        """
+        Check if the response can be used without asking the site
+
+        :param max_age: Number of seconds a response stays fresh
+        """
+        return datetime.utcnow() - self.fetched_at < timedelta(
+            seconds=max_age or 0
+        )
+
+    @classmethod
+    def store(cls, channel, url, content, etag=None, last_modified=None):
+        """
+        Store the response for the url and evict the least recently used
+        responses of the channel if the cache is full
+
+        :param channel: Active record of the channel
+        :param url: URL of the request including the query string
+        :param content: Body of the response
+        :param etag: ETag header of the response
+        :param last_modified: Last-Modified header of the response
+        """
+        now = datetime.utcnow()
+        values = {
+            'content': buffer(content),
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': now,
+            'last_access': now,
+        }
+        entries = cls.search([
+            ('channel', '=', channel.id),
+            ('url', '=', url),
+        ])
+        if entries:
+            cls.write(entries, values)
+        else:
+            values.update({
+                'channel': channel.id,
+                'url': url,
+            })
+            cls.create([values])
+            cls.evict(channel, channel.prestashop_cache_size)
+
+    @classmethod
+    def evict(cls, channel, size):
+        """
+        Drop the least recently used responses of the channel to keep only
+        `size` responses in the cache
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*table.select(
+            Count(Literal(1)), where=table.channel == channel.id
+        ))
+        count, = cursor.fetchone()
+        if count <= size:
+            return
+
+        cursor.execute(*table.select(
+            table.id, where=table.channel == channel.id,
+            order_by=[table.last_access.asc, table.id.asc],
+            limit=count - size
+        ))
+        ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(*table.delete(where=table.id.in_(ids)))
+
+    @classmethod
+    def clear(cls, channels):
+        """
+        Drop all the cached responses of the channels
+        """
+        cls.delete(cls.search([('channel', 'in', map(int, channels))]))
+
+
+class ChannelHTTPCache(object):
+    """
+    Cache used by the webservice session of a channel
+
+    The cache is stored in the database, so it is used only when the request
+    is sent from a thread which runs a transaction.
+
+    On postgresql, the cache is read and written in short transactions of
+    its own, committed at once, on a cursor opened once and kept until the
+    end of the sync run, see `close`. The responses are shared by all the
+    workers of the channel, which would otherwise lock each other's rows
+    until the end of their sync runs. An error in such a transaction, like
+    a response stored by two workers at once, only costs a miss. On other
+    databases the cache is read and written in the transaction of the
+    caller. The processes which import the orders of a channel together do
+    not store any response, see the `prestashop_http_cache_read_only`
+    context key.
+
+    The last access times of the responses used are kept in memory and
+    written at once by `flush`, so that a response served from the cache
+    costs a single read.
+    """
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self._cursor = None
+        self._accessed = set()
+
+    @property
+    def available(self):
+        return Transaction().cursor is not None
+
+    @property
+    def channel(self):
+        return Pool().get('sale.channel')(self.channel_id)
+
+    def open_cursor(self):
+        """
+        Return a new cursor on the database of the current transaction
+        """
+        Database = backend.get('Database')
+        database = Database(Transaction().cursor.database_name).connect()
+        return database.cursor()
+
+    def run(self, func, *args):
+        """
+        Call func with the arguments, in a transaction of its own on
+        postgresql
+
+        :returns: The result of func, or None if the transaction failed
+        """
+        if backend.name() != 'postgresql':
+            return func(*args)
+
+        errors = (
+            UserError,
+            backend.get('DatabaseIntegrityError'),
+            backend.get('DatabaseOperationalError'),
+        )
+        if self._cursor is None:
+            self._cursor = self.open_cursor()
+        cursor = self._cursor
+        with Transaction().set_cursor(cursor):
+            try:
+                result = func(*args)
+                cursor.commit()
+            except errors:
+                logger.debug(
+                    'HTTP cache of channel %s not updated', self.channel_id,
+                    exc_info=True
+                )
+                cursor.rollback()
+                return None
+            except Exception:
+                cursor.rollback()
+                raise
+        return result
+
+    def flush(self):
+        """
+        Write the last access time of the responses used
+        """
+        if not self._accessed or not self.available:
+            return
+        ids, self._accessed = list(self._accessed), set()
+        self.run(self._touch, ids)
+
+    def _touch(self, ids):
+        HTTPCache = Pool().get('prestashop.http.cache')
+
+        # Entries dropped in the meantime are skipped
+        HTTPCache.touch(HTTPCache.search([('id', 'in', ids)]))
+
+    def close(self):
+        """
+        Release the cursor of the cache. The last access times which were
+        not flushed are lost.
+        """
+        self._accessed = set()
+        if self._cursor is not None:
+            cursor, self._cursor = self._cursor, None
+            cursor.close()
+
+    def get(self, url):
+        """
+        Return a tuple of the content, etag, last modified header and
+        whether the response is fresh, or None if the url is not cached
+        """
+        return self.run(self._get, url)
+
+    def _get(self, url):
+        HTTPCache = Pool().get('prestashop.http.cache')
+
+        channel = self.channel
+        if not channel.prestashop_cache_size:
+            return None
+
+        entry = HTTPCache.lookup(channel, url)
+        if entry is None:
+            return None
+        if entry.needs_touch():
+            self._accessed.add(entry.id)
+        return (
+            str(entry.content), entry.etag, entry.last_modified,
+            entry.is_fresh(channel.prestashop_cache_max_age)
+        )
+
+    def set(self, url, content, etag=None, last_modified=None):
+        """
+        Store the content of the response for the url
+        """
+        self.run(self._set, url, content, etag, last_modified)
+
+    def _set(self, url, content, etag, last_modified):
+        HTTPCache = Pool().get('prestashop.http.cache')
+
+        channel = self.channel
+        if not channel.prestashop_cache_size or \
+                Transaction().context.get('prestashop_http_cache_read_only'):
+            return
+        HTTPCache.store(channel, url, content, etag, last_modified)
+
+    def revalidated(self, url):
+        """
+        The site confirmed that the cached content of the url is still good
+        """
+        self.run(self._revalidated, url)
+
+    def _revalidated(self, url):
+        HTTPCache = Pool().get('prestashop.http.cache')
+
+        entries = HTTPCache.search([
+            ('channel', '=', self.channel_id),
+            ('url', '=', url),
+        ])
+        if entries:
+            HTTPCache.write(entries, {'fetched_at': datetime.utcnow()})
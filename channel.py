@@ -3,24 +3,41 @@
     prestashop
 
 """
-from datetime import datetime
+import time
+import logging
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
 
 import pytz
 import requests
 import pystashop
-from mockstashop import MockstaShopWebservice
+from trytond import backend
 from trytond.model import ModelView, fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
 from trytond.wizard import Wizard, StateView, Button
 from trytond.pyson import Eval
-
+from trytond.rpc import RPC
+
+from webservice import (
+    client_registry, make_display, MockPrestashopClient, DEFAULT_POOL_SIZE,
+    DEFAULT_MAX_CONCURRENCY, DEFAULT_RATE_LIMIT, DEFAULT_BURST
+)
+from throttle import CircuitOpenError
+from cache import ChannelHTTPCache
+from shard import split_in_shards, run_in_processes, import_order_shard
+from job import savepoint, has_savepoints, JOB_BATCH_SIZE
+from timing import RunReport, RunTimings, collect, count_queries, stage
 __metaclass__ = PoolMeta
 __all__ = [
-    'Channel', 'PrestashopExportOrdersWizardView',
+    'Channel', 'ChannelException', 'PrestashopExportOrdersWizardView',
     'PrestashopExportOrdersWizard',
     'PrestashopConnectionWizardView', 'PrestashopConnectionWizard',
 ]
+logger = logging.getLogger(__name__)
+
 TIMEZONES = [(None, '')] + [(x, x) for x in pytz.common_timezones]
 
 PRESTASHOP_STATES = {
@@ -31,6 +48,40 @@ INVISIBLE_IF_NOT_PRESTASHOP = {
     'invisible': ~(Eval('source') == 'prestashop')
 }
 
+#: Number of orders read and imported in a page, which is committed
+#: before the next one is read
+ORDER_PAGE_SIZE = 100
+
+#: Highest id of a prestashop record, the upper bound of the id filters
+MAX_PRESTASHOP_ID = 4294967295
+
+#: Format of the dates of prestashop
+PRESTASHOP_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+#: Errors of the site rather than of an order, which stop the import
+#: instead of failing the orders one by one
+SITE_ERRORS = (CircuitOpenError, requests.Timeout, requests.ConnectionError)
+
+#: Number of channels whose orders are exported at the same time
+EXPORT_MAX_WORKERS = 4
+
+#: First key of the advisory locks taken on the channels, the second one
+#: is the ID of the channel
+CHANNEL_LOCK_CLASS = 0x5053
+
+#: Duration of the exports of the channels run by the cron of this process
+export_timings = RunTimings()
+_export_pool = None
+
+#: Name of the prestashop state to which an order is moved when its sale
+#: reaches a state.
+#: XXX: Though final state in prestashop is delivered, but till we don't have
+#: provision to get delivery status, set it to shipped.
+EXPORT_STATE_NAMES = {
+    'cancel': 'Canceled',
+    'done': 'Shipped',
+}
+
 
 class Channel:
     """
@@ -48,6 +99,63 @@ class Channel:
         'Prestashop Key', states=PRESTASHOP_STATES, depends=['source']
     )
 
+    #: Number of connections kept alive with the prestashop site
+    prestashop_pool_size = fields.Integer(
+        'Connection Pool Size', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    #: Number of requests sent to the prestashop site at the same time
+    prestashop_max_concurrency = fields.Integer(
+        'Concurrent Requests', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    #: Number of requests per second allowed to the prestashop site.
+    #: The rate is lowered automatically when the site asks to slow down.
+    prestashop_rate_limit = fields.Float(
+        'Requests Per Second', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source'], help='Set to 0 to disable rate limiting'
+    )
+
+    #: Number of requests which can be sent at once without waiting
+    prestashop_burst = fields.Integer(
+        'Request Burst', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
+    #: Number of responses of the resources which rarely change, like
+    #: countries and currencies, kept in the cache
+    prestashop_cache_size = fields.Integer(
+        'Response Cache Size', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source'], help='Set to 0 to disable the cache'
+    )
+
+    #: Number of seconds a cached response is used without asking the site
+    #: if it changed
+    prestashop_cache_max_age = fields.Integer(
+        'Response Cache Max Age', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source'], help='In seconds'
+    )
+
+    #: Format in which the records are read from the prestashop site.
+    #: JSON responses are a third smaller, and the parsed records take a
+    #: little less memory, but JSON takes about three times longer to parse
+    #: than XML. XML is kept as the default, JSON is for sites where the
+    #: bandwidth matters more than the CPU.
+    prestashop_output_format = fields.Selection(
+        [('XML', 'XML'), ('JSON', 'JSON')], 'Output Format',
+        states=PRESTASHOP_STATES, depends=['source'],
+        help='JSON responses are smaller but slower to read than XML'
+    )
+
+    #: Number of processes among which the orders of an import are shared.
+    #: The orders of a customer are always imported by the same process.
+    prestashop_import_processes = fields.Integer(
+        'Import Processes', states=INVISIBLE_IF_NOT_PRESTASHOP,
+        depends=['source']
+    )
+
     prestashop_shipping_product = fields.Many2One(
         'product.product', 'Shipping Product', states=PRESTASHOP_STATES,
         domain=[
@@ -82,6 +190,38 @@ class Channel:
         depends=['source']
     )
 
+    @staticmethod
+    def default_prestashop_pool_size():
+        return DEFAULT_POOL_SIZE
+
+    @staticmethod
+    def default_prestashop_max_concurrency():
+        return DEFAULT_MAX_CONCURRENCY
+
+    @staticmethod
+    def default_prestashop_rate_limit():
+        return DEFAULT_RATE_LIMIT
+
+    @staticmethod
+    def default_prestashop_burst():
+        return DEFAULT_BURST
+
+    @staticmethod
+    def default_prestashop_output_format():
+        return 'XML'
+
+    @staticmethod
+    def default_prestashop_import_processes():
+        return 1
+
+    @staticmethod
+    def default_prestashop_cache_size():
+        return 1000
+
+    @staticmethod
+    def default_prestashop_cache_max_age():
+        return 3600
+
     @classmethod
     def get_source(cls):
         """
@@ -113,30 +253,333 @@ class Channel:
             'languages_not_imported':
                 'Import the languages before importing order states',
             'order_states_not_imported':
-                'Import the order states before importing/exporting orders'
+                'Import the order states before importing/exporting orders',
+            'prestashop_unavailable':
+                'Prestashop site is not responding. Try again later.\n%s',
         })
         cls._buttons.update({
             'test_prestashop_connection': {},
             'import_prestashop_languages': {},
             'export_prestashop_orders_button': {},
         })
+        cls.__rpc__.update({
+            'dry_run_prestashop_import': RPC(readonly=False, instantiate=0),
+        })
+
+    @classmethod
+    def write(cls, *args):
+        """
+        Drop the cached webservice clients of channels whose connection
+        settings are changed
+        """
+        actions = iter(args)
+        channel_ids = []
+        for channels, values in zip(actions, actions):
+            if set(values) & set([
+                'prestashop_url', 'prestashop_key', 'prestashop_pool_size',
+                'prestashop_max_concurrency', 'prestashop_rate_limit',
+                'prestashop_burst', 'prestashop_output_format',
+            ]):
+                channel_ids.extend(map(int, channels))
+
+        super(Channel, cls).write(*args)
+
+        if channel_ids:
+            client_registry.invalidate(
+                Transaction().cursor.database_name, channel_ids
+            )
 
     def get_prestashop_client(self):
         """
         Returns an authenticated instance of the Prestashop client
 
+        The client is shared by all the calls made for this channel from the
+        same worker, so that the connections to the site are reused.
+
         :return: Prestashop client object
         """
         if not all([self.prestashop_url, self.prestashop_key]):
             self.raise_user_error('prestashop_settings_missing')
 
+        database_name = Transaction().cursor.database_name
         if Transaction().context.get('ps_test'):
-            return MockstaShopWebservice('Some URL', 'A Key')
+            client = MockPrestashopClient('Some URL', 'A Key')
+        else:
+            client = client_registry.get(
+                database_name, self.id,
+                self.prestashop_url, self.prestashop_key,
+                self.prestashop_pool_size, self.prestashop_max_concurrency,
+                self.prestashop_rate_limit, self.prestashop_burst,
+                cache=ChannelHTTPCache(self.id),
+                output_format=self.prestashop_output_format,
+            )
+        client.run_cache = client_registry.get_run_cache(
+            database_name, self.id
+        )
+        return client
 
-        return pystashop.PrestaShopWebservice(
-            self.prestashop_url, self.prestashop_key
+    def prefetch_prestashop_orders(self, orders, rows_by_order=None):
+        """
+        Read at once every remote record needed to import the orders: the
+        customers, addresses, order details, currencies, countries, states
+        and products. A page of orders takes a few list requests instead of
+        several requests per order. The records are kept in the run cache,
+        where the mappers find them, and the orders are marked as
+        prefetched so that their import does not look for them again.
+        Nothing is read outside of a run.
+
+        :param orders: List of order records sent by pystashop
+        :param rows_by_order: Dictionary of the order ID to the list of
+                              order_details records of the orders read
+                              without their associations
+        """
+        Line = Pool().get('sale.line')
+
+        client = self.get_prestashop_client()
+        if client.run_cache is None:
+            return
+
+        calls, order_rows = [], []
+        for order in orders:
+            calls.extend([
+                ('customers', order.id_customer.pyval),
+                ('addresses', order.id_address_invoice.pyval),
+                ('addresses', order.id_address_delivery.pyval),
+            ])
+            if hasattr(order, 'associations'):
+                rows = list(order.associations.order_rows.iterchildren())
+                calls.extend(
+                    ('order_details', row.id.pyval) for row in rows
+                    if not Line.has_ps_line_data(row)
+                )
+            else:
+                rows = (rows_by_order or {}).get(order.id.pyval, [])
+            order_rows.extend(rows)
+        records = client.fetch_many(calls)
+
+        self.prefetch_prestashop_records(
+            addresses=[
+                record for (resource, _), record in records.iteritems()
+                if resource == 'addresses'
+            ],
+            order_rows=order_rows,
+            currency_ids=[order.id_currency.pyval for order in orders],
+        )
+        client.run_cache.mark_prefetched(
+            [order.id.pyval for order in orders]
         )
 
+    def prefetch_prestashop_records(
+        self, addresses=None, order_rows=None, currency_ids=None
+    ):
+        """
+        Read at once the countries, states, currencies and products needed
+        to import the given addresses and order rows which are not known in
+        tryton yet. The records are kept in the run cache, where the lookups
+        done while importing find them. Nothing is read outside of a run.
+
+        :param addresses: List of address records sent by pystashop
+        :param order_rows: List of order row records sent by pystashop
+        :param currency_ids: List of prestashop currency IDs
+        """
+        CountryPrestashop = Pool().get('country.country.prestashop')
+        SubdivisionPrestashop = Pool().get('country.subdivision.prestashop')
+        CurrencyPrestashop = Pool().get('currency.currency.prestashop')
+
+        client = self.get_prestashop_client()
+        if client.run_cache is None:
+            return
+
+        addresses = addresses or []
+        ids_by_resource = [
+            ('countries', CountryPrestashop, set(
+                address.id_country.pyval for address in addresses
+                if address.id_country
+            )),
+            ('states', SubdivisionPrestashop, set(
+                address.id_state.pyval for address in addresses
+                if address.id_state
+            )),
+            ('currencies', CurrencyPrestashop, set(currency_ids or [])),
+        ]
+
+        calls = []
+        for resource, Model, ids in ids_by_resource:
+            known = set(record.prestashop_id for record in Model.search([
+                ('channel', '=', self.id),
+                ('prestashop_id', 'in', list(ids)),
+            ])) if ids else set()
+            calls.extend((resource, id) for id in ids - known)
+
+        order_rows = order_rows or []
+        skus = self.load_prestashop_skus([
+            unicode(row.product_reference.pyval) for row in order_rows
+            if row.product_reference.pyval
+        ])
+        for row in order_rows:
+            if row.product_reference.pyval and \
+                    skus[unicode(row.product_reference.pyval)][1]:
+                continue
+            if row.product_attribute_id.pyval != 0:
+                calls.append(
+                    ('combinations', row.product_attribute_id.pyval)
+                )
+            calls.append(('products', row.product_id.pyval))
+
+        if calls:
+            client.fetch_many(calls)
+
+    def end_prestashop_page(self):
+        """
+        Drop the records read for the page of orders just imported from the
+        cache of the current sync run
+        """
+        run_cache = client_registry.get_run_cache(
+            Transaction().cursor.database_name, self.id
+        )
+        if run_cache is not None:
+            run_cache.end_page()
+
+    def get_prestashop_sku_index(self):
+        """
+        Return the index of the SKUs of the current sync run, or None outside
+        of a run. It maps a SKU to a tuple of the IDs of its product and of
+        its listing on this channel, None when there is none.
+        """
+        run_cache = client_registry.get_run_cache(
+            Transaction().cursor.database_name, self.id
+        )
+        return run_cache and run_cache.skus
+
+    def search_prestashop_skus(self, skus):
+        """
+        Return the IDs of the product and of the listing of the SKUs, read
+        from the database
+
+        :param skus: List of SKUs
+        :returns: A dictionary of the SKU to a tuple of the product ID and
+                  the listing ID, None when there is none
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+
+        skus = list(set(skus))
+        product_ids, listing_ids = {}, {}
+        if skus:
+            for product in Product.search_read([
+                ('code', 'in', skus),
+            ], fields_names=['code']):
+                product_ids.setdefault(product['code'], product['id'])
+            for listing in Listing.search_read([
+                ('product_identifier', 'in', skus),
+                ('channel', '=', self.id),
+            ], fields_names=['product_identifier']):
+                listing_ids.setdefault(
+                    listing['product_identifier'], listing['id']
+                )
+        return dict(
+            (sku, (product_ids.get(sku), listing_ids.get(sku)))
+            for sku in skus
+        )
+
+    def load_prestashop_skus(self, skus):
+        """
+        Add the SKUs to the index of the current run, reading the ones the
+        run does not know yet at once
+
+        :param skus: List of SKUs
+        :returns: A dictionary of the SKU to a tuple of the product ID and
+                  the listing ID, None when there is none
+        """
+        index = self.get_prestashop_sku_index()
+        if index is None:
+            return self.search_prestashop_skus(skus)
+        index.update(self.search_prestashop_skus(
+            [sku for sku in skus if sku not in index]
+        ))
+        return dict((sku, index[sku]) for sku in skus)
+
+    def get_prestashop_sku(self, sku):
+        """
+        Return the IDs of the product and of the listing of the SKU, from
+        the index of the current run if it knows the SKU
+
+        :param sku: SKU of the product
+        :returns: A tuple of the product ID and the listing ID, None when
+                  there is none
+        """
+        index = self.get_prestashop_sku_index()
+        if index is not None and sku in index:
+            return index[sku]
+        return self.load_prestashop_skus([sku])[sku]
+
+    def set_prestashop_sku(self, sku, product_id=None, listing_id=None):
+        """
+        Record the product or the listing created for the SKU in the index
+        of the current run
+
+        :param sku: SKU of the product
+        :param product_id: ID of the product, None to keep the known one
+        :param listing_id: ID of the listing, None to keep the known one
+        """
+        index = self.get_prestashop_sku_index()
+        if index is None or sku not in index:
+            return
+        known_product_id, known_listing_id = index[sku]
+        index[sku] = (
+            product_id or known_product_id, listing_id or known_listing_id
+        )
+
+    def clear_prestashop_sku_index(self):
+        """
+        Forget the SKUs of the current run, after the products and listings
+        created in it were rolled back
+        """
+        index = self.get_prestashop_sku_index()
+        if index is not None:
+            index.clear()
+
+    def get_prestashop_client_stats(self):
+        """
+        Returns the statistics of the rate limiter and the circuit breaker of
+        this channel in the current process. Useful to tune the rate limit of
+        a site.
+
+        :return: Dictionary of statistics or None if no request was sent
+        """
+        return client_registry.get_stats(
+            Transaction().cursor.database_name, self.id
+        )
+
+    @contextmanager
+    def prestashop_run(self):
+        """
+        Context manager for a sync run with the prestashop site.
+
+        Records read more than once during the run, like the customer of
+        many orders, are read from the site only once.
+
+        If the site stops responding in the middle of the run, the run is
+        stopped with a user error so that the transaction is rolled back.
+        """
+        database_name = Transaction().cursor.database_name
+        run_cache, started = client_registry.start_run(
+            database_name, self.id
+        )
+        try:
+            yield
+        except CircuitOpenError, exc:
+            self.raise_user_error('prestashop_unavailable', (exc,))
+        finally:
+            if started:
+                client_registry.end_run(database_name, self.id)
+                logger.info(
+                    'Prestashop client stats for channel %s: %s, '
+                    'run cache: %s', self.id,
+                    self.get_prestashop_client_stats(),
+                    run_cache.get_stats()
+                )
+
     @classmethod
     @ModelView.button
     def import_prestashop_languages(cls, channels):
@@ -158,7 +601,9 @@ class Channel:
         with Transaction().set_context(current_channel=channel.id):
 
             client = channel.get_prestashop_client()
-            languages = client.languages.get_list(display='full')
+            languages = client.languages.get_list(
+                display=make_display(SiteLanguage.get_ps_fields())
+            )
 
             new_records = []
             for lang in languages:
@@ -196,6 +641,13 @@ class Channel:
         ):
             cls.raise_user_error('wrong_url')
 
+    def get_ps_order_state_fields(self):
+        """
+        Return the fields of the prestashop order states read by
+        `import_order_states`. Return None to read the full records.
+        """
+        return ['id', 'name']
+
     def import_order_states(self):
         """
         Import order states for prestashop channel
@@ -213,7 +665,9 @@ class Channel:
                 self.raise_user_error('languages_not_imported')
 
             client = self.get_prestashop_client()
-            order_states = client.order_states.get_list(display='full')
+            order_states = client.order_states.get_list(
+                display=make_display(self.get_ps_order_state_fields())
+            )
 
             for state in order_states:
                 # The name of a state can be in multiple languages
@@ -257,55 +711,667 @@ class Channel:
         utc_time_now = datetime.utcnow()
         site_tz = pytz.timezone(self.prestashop_timezone)
         time_now = site_tz.normalize(pytz.utc.localize(utc_time_now))
-        client = self.get_prestashop_client()
 
-        with Transaction().set_context(current_channel=self.id):
-            filters = {
-                'current_state': '|'.join(map(
-                    lambda s: s.code, order_states_to_import
-                ))
-            }
+        filters, date = self.get_order_import_filters(
+            order_states_to_import, site_tz, time_now
+        )
+
+        if self.use_prestashop_import_processes():
+            return self.import_orders_in_processes(
+                filters, date, utc_time_now
+            )
+
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            client = self.get_prestashop_client()
+            display = make_display(Sale.get_ps_order_fields())
+
+            sales_imported = []
+            # The last order read, as the page after it is read next
+            after = None
             if self.last_order_import_time:
-                # In tryton all time stored is in UTC
-                # Convert the last import time to timezone of the site
-                last_order_import_time = site_tz.normalize(
+                after = (site_tz.normalize(
                     pytz.utc.localize(self.last_order_import_time)
+                ).strftime(PRESTASHOP_DATE_FORMAT), 0)
+            while True:
+                orders = self.get_prestashop_order_page(
+                    client, display, filters, after, time_now
                 )
-                filters['date_upd'] = '{0},{1}'.format(
-                    last_order_import_time.strftime(
-                        '%Y-%m-%d %H:%M:%S'
-                    ),
-                    time_now.strftime('%Y-%m-%d %H:%M:%S')
+                if not orders:
+                    break
+
+                sales_imported.extend(self.import_prestashop_orders(orders))
+
+                # Only the orders read so far are known to be imported, so
+                # the next run starts from the last of them
+                last = (unicode(orders[-1].date_upd), orders[-1].id.pyval)
+                self.commit_order_import_time(pytz.utc.normalize(
+                    site_tz.localize(
+                        datetime.strptime(last[0], PRESTASHOP_DATE_FORMAT)
+                    )
+                ).replace(tzinfo=None))
+                self.end_prestashop_page()
+
+                # A site which does not filter the list would send the same
+                # page again
+                if len(orders) < ORDER_PAGE_SIZE or \
+                        (after is not None and last <= after):
+                    break
+                after = last
+
+            sales_imported.extend(self.process_prestashop_import_jobs())
+
+        return sales_imported
+
+    def get_prestashop_order_page(
+            self, client, display, filters, after, time_now):
+        """
+        Return the page of the orders to import which follows an order, in
+        the order of their last update and id
+
+        The page is found from the last order read rather than from an
+        offset, so the orders updated during the import, which move to the
+        end of the list, do not shift the pages and no order is skipped.
+
+        :param client: Prestashop client of the channel
+        :param display: Fields of the orders to read
+        :param filters: Filters of the orders to import, but the update time
+        :param after: Tuple of the update time, in the timezone of the site,
+                      and id of the order after which the page starts, or
+                      None to start from the first order
+        :param time_now: Time of the import in the timezone of the site
+        :returns: List of the orders of the page
+        """
+        sort = [('date_upd', 'ASC'), ('id', 'ASC')]
+        if after is None:
+            orders = list(client.iter_list(
+                'orders', display=display, filters=filters, sort=sort,
+                limit=ORDER_PAGE_SIZE
+            ))
+        else:
+            last_date_upd, last_id = after
+            # The orders updated at the same time as the last one but with
+            # a higher id, then the ones updated later
+            orders = list(client.iter_list(
+                'orders', display=display, filters=dict(
+                    filters,
+                    date_upd='{0},{0}'.format(last_date_upd),
+                    id='{0},{1}'.format(last_id + 1, MAX_PRESTASHOP_ID),
+                ), date=1, sort=[('id', 'ASC')], limit=ORDER_PAGE_SIZE
+            ))
+            if len(orders) < ORDER_PAGE_SIZE:
+                next_date_upd = datetime.strptime(
+                    last_date_upd, PRESTASHOP_DATE_FORMAT
+                ) + timedelta(seconds=1)
+                orders.extend(client.iter_list(
+                    'orders', display=display, filters=dict(
+                        filters, date_upd='{0},{1}'.format(
+                            next_date_upd.strftime(PRESTASHOP_DATE_FORMAT),
+                            time_now.strftime(PRESTASHOP_DATE_FORMAT)
+                        )
+                    ), date=1, sort=sort,
+                    limit=ORDER_PAGE_SIZE - len(orders)
+                ))
+
+        # Keep the page in order, and an order read by both requests once
+        orders_by_key = dict(
+            ((unicode(order.date_upd), order.id.pyval), order)
+            for order in orders
+        )
+        return [orders_by_key[k] for k in sorted(orders_by_key)]
+
+    def get_order_import_filters(self, order_states, site_tz, time_now):
+        """
+        Return the filters of the orders to import
+
+        :param order_states: Order states whose orders are imported
+        :param site_tz: Timezone of the site
+        :param time_now: Time of the import in the timezone of the site
+        :returns: A tuple of the filters and the date flag of the request
+        """
+        filters = {
+            'current_state': '|'.join(map(lambda s: s.code, order_states))
+        }
+        date = None
+        if self.last_order_import_time:
+            # In tryton all time stored is in UTC
+            # Convert the last import time to timezone of the site
+            last_order_import_time = site_tz.normalize(
+                pytz.utc.localize(self.last_order_import_time)
+            )
+            filters['date_upd'] = '{0},{1}'.format(
+                last_order_import_time.strftime(PRESTASHOP_DATE_FORMAT),
+                time_now.strftime(PRESTASHOP_DATE_FORMAT)
+            )
+            date = 1
+        return filters, date
+
+    def use_prestashop_import_processes(self):
+        """
+        Return True if the orders are imported by many processes
+
+        Processes are not used on sqlite, which does not allow concurrent
+        writes, nor in tests and dry runs, which run in a single
+        transaction.
+        """
+        context = Transaction().context
+        return (
+            (self.prestashop_import_processes or 1) > 1 and
+            backend.name() != 'sqlite' and
+            not context.get('ps_test') and
+            not context.get('prestashop_dry_run')
+        )
+
+    def import_orders_in_processes(self, filters, date, utc_time_now):
+        """
+        Import the orders in many processes
+
+        The IDs of the orders to import are listed first and shared among
+        the processes by customer. The records shared by the orders of
+        different customers are created beforehand by the current process,
+        see `resolve_prestashop_references`. Each process imports and
+        commits its orders in its own transaction. The last import time is
+        moved only once all the processes succeeded, so a failed import is
+        run again from the same point and the orders already imported are
+        skipped.
+
+        :param filters: Filters of the orders to import
+        :param date: Date flag of the request
+        :param utc_time_now: Time of the start of the import in UTC
+        :returns: The list of active records of sales imported
+        """
+        Sale = Pool().get('sale.sale')
+
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            client = self.get_prestashop_client()
+            orders = list(client.iter_list(
+                'orders', display=['id', 'id_customer'], filters=filters,
+                date=date, sort=[('id', 'ASC')]
+            ))
+
+        shards = split_in_shards(orders, self.prestashop_import_processes)
+        if shards:
+            self.resolve_prestashop_references(
+                [order.id.pyval for order in orders]
+            )
+            # Work done so far must be visible to the processes
+            transaction = Transaction()
+            transaction.cursor.commit()
+            # The processes only read the responses cached by this one, so
+            # that two of them never store the same response
+            context = dict(
+                transaction.context, prestashop_http_cache_read_only=True
+            )
+            run_in_processes(len(shards), import_order_shard, [(
+                transaction.cursor.database_name, transaction.user,
+                context, self.id, order_ids
+            ) for order_ids in shards])
+
+        sales = Sale.search([
+            ('channel', '=', self.id),
+            ('channel_identifier', 'in', [
+                str(order.id.pyval) for order in orders
+            ]),
+        ])
+
+        sales.extend(self.process_prestashop_import_jobs())
+
+        self.commit_order_import_time(utc_time_now)
+        return sales
+
+    def resolve_prestashop_references(self, order_ids):
+        """
+        Create the records shared by the orders before they are imported by
+        many processes: the countries, states and currencies of the channel,
+        and the products and their listings. The processes then find them,
+        so two processes never create the same record. An order whose
+        records cannot be created is left to its process, which fails it.
+
+        :param order_ids: List of IDs of the orders on prestashop
+        """
+        Sale = Pool().get('sale.sale')
+
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            client = self.get_prestashop_client()
+            for start in range(0, len(order_ids), ORDER_PAGE_SIZE):
+                orders = client.get_list_in(
+                    'orders', 'id', order_ids[start:start + ORDER_PAGE_SIZE],
+                    fields=Sale.get_ps_order_fields()
                 )
-                orders_to_import = client.orders.get_list(
-                    filters=filters, date=1, display='full'
+                rows_by_order = Sale.get_ps_order_rows([
+                    order.id.pyval for order in orders
+                    if not hasattr(order, 'associations')
+                ])
+                self.prefetch_prestashop_orders(orders, rows_by_order)
+
+                for order in orders:
+                    if not has_savepoints():
+                        self.resolve_prestashop_order_references(
+                            order, rows_by_order
+                        )
+                        continue
+                    try:
+                        with savepoint('prestashop_references'):
+                            self.resolve_prestashop_order_references(
+                                order, rows_by_order
+                            )
+                    except SITE_ERRORS:
+                        raise
+                    except Exception:
+                        logger.warning(
+                            'Records of order %s of channel %s could not be '
+                            'created', order.id.pyval, self.id, exc_info=True
+                        )
+                        self.clear_prestashop_sku_index()
+                self.commit_prestashop_import()
+                self.end_prestashop_page()
+
+    def resolve_prestashop_order_references(self, order, rows_by_order):
+        """
+        Create the country, state, currency and product records needed by
+        the order, see `resolve_prestashop_references`
+
+        :param order: Order record sent by pystashop
+        :param rows_by_order: Dictionary of the order ID to the list of
+                              order_details records of the orders read
+                              without their associations
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+        Currency = Pool().get('currency.currency')
+
+        client = self.get_prestashop_client()
+        Currency.get_using_ps_id(order.id_currency.pyval)
+        addresses = client.get_many('addresses', [
+            order.id_address_invoice.pyval, order.id_address_delivery.pyval
+        ])
+        for address in addresses.itervalues():
+            if address.id_country:
+                Country.get_using_ps_id(address.id_country.pyval)
+            if address.id_state:
+                Subdivision.get_using_ps_id(address.id_state.pyval)
+
+        if hasattr(order, 'associations'):
+            rows = order.associations.order_rows.iterchildren()
+        else:
+            rows = rows_by_order.get(order.id.pyval, [])
+        for row in rows:
+            self.get_product(row)
+
+    def import_prestashop_order_ids(self, order_ids):
+        """
+        Read the orders with the given IDs from prestashop and import them
+
+        :param order_ids: List of IDs of the orders on prestashop
+        :returns: The list of active records of sales imported
+        """
+        Sale = Pool().get('sale.sale')
+
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            client = self.get_prestashop_client()
+            orders = client.get_list_in(
+                'orders', 'id', order_ids, fields=Sale.get_ps_order_fields()
+            )
+            return self.import_prestashop_orders(orders)
+
+    def import_prestashop_orders(self, orders):
+        """
+        Import a page of orders read from prestashop
+
+        :param orders: List of order records sent by pystashop
+        :returns: The list of active records of sales imported, without the
+                  orders which failed
+        """
+        Sale = Pool().get('sale.sale')
+        ImportJob = Pool().get('prestashop.import.job')
+
+        # Orders already imported are found with one query and skipped
+        existing_sales = Sale.get_orders_using_ps_data(orders)
+        new_orders = [
+            order for order in orders
+            if order.id.pyval not in existing_sales
+        ]
+
+        # Orders read with a list of fields come without their associations,
+        # so their rows are read from the order details
+        rows_by_order = Sale.get_ps_order_rows([
+            order.id.pyval for order in new_orders
+            if not hasattr(order, 'associations')
+        ])
+
+        self.prefetch_prestashop_orders(new_orders, rows_by_order)
+
+        # Sales of a page are created together, an order listed twice is
+        # created once
+        to_create, to_create_rows, seen = [], [], set()
+        for order in new_orders:
+            if order.id.pyval in seen:
+                continue
+            seen.add(order.id.pyval)
+            to_create.append(order)
+            order_rows = None
+            if not hasattr(order, 'associations'):
+                order_rows = rows_by_order.get(order.id.pyval, [])
+            to_create_rows.append(order_rows)
+        existing_sales.update(
+            self.create_prestashop_orders(to_create, to_create_rows)
+        )
+
+        ImportJob.mark_done(self, 'orders', list(existing_sales))
+        return [
+            existing_sales[order.id.pyval] for order in orders
+            if order.id.pyval in existing_sales
+        ]
+
+    def create_prestashop_orders(self, orders, order_rows):
+        """
+        Create the sales of the orders
+
+        The sales are created together in a savepoint. If one of the orders
+        fails, the others are created one by one in their own savepoint and
+        the failed orders are left in the import queue to be retried later.
+        An error of the site, like an open circuit breaker, is not the fault
+        of an order and aborts the import, as does a failed order without
+        savepoints.
+
+        :param orders: List of order records sent by pystashop
+        :param order_rows: List of the rows of every order or None
+        :returns: A dictionary of the sales created by order ID
+        """
+        Sale = Pool().get('sale.sale')
+        ImportJob = Pool().get('prestashop.import.job')
+
+        if not orders:
+            return {}
+        order_ids = [order.id.pyval for order in orders]
+
+        if not has_savepoints():
+            return dict(zip(
+                order_ids, Sale.create_all_using_ps_data(orders, order_rows)
+            ))
+
+        try:
+            with savepoint('prestashop_orders'):
+                return dict(zip(
+                    order_ids,
+                    Sale.create_all_using_ps_data(orders, order_rows)
+                ))
+        except SITE_ERRORS:
+            raise
+        except Exception:
+            logger.warning(
+                'Import of %d orders of channel %s failed, importing them '
+                'one by one', len(orders), self.id
+            )
+            self.clear_prestashop_sku_index()
+
+        sales = {}
+        for order_id, order, rows in zip(order_ids, orders, order_rows):
+            try:
+                with savepoint('prestashop_order'):
+                    sales[order_id], = Sale.create_all_using_ps_data(
+                        [order], [rows]
+                    )
+            except SITE_ERRORS:
+                raise
+            except Exception, exc:
+                logger.exception(
+                    'Import of order %s of channel %s failed',
+                    order_id, self.id
                 )
-            else:
-                orders_to_import = client.orders.get_list(
-                    display='full', filters=filters
+                self.clear_prestashop_sku_index()
+                ImportJob.register_failure(self, 'orders', order_id, exc)
+        return sales
+
+    def process_prestashop_import_jobs(self):
+        """
+        Import the orders of the jobs of the channel which are due, a batch
+        of jobs at a time. Every batch is committed, so that its jobs are
+        released for the other workers.
+
+        :returns: The list of active records of sales imported
+        """
+        ImportJob = Pool().get('prestashop.import.job')
+
+        sales = []
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            while True:
+                jobs = ImportJob.claim(self, 'orders', JOB_BATCH_SIZE)
+                if not jobs:
+                    break
+                sales.extend(self.import_prestashop_order_ids(
+                    [job.remote_id for job in jobs]
+                ))
+
+                # Orders which are not sent by the site anymore
+                for job in ImportJob.browse(map(int, jobs)):
+                    if job.status == 'pending' or (
+                        job.status == 'failed' and
+                        job.next_attempt <= job.started_at
+                    ):
+                        ImportJob.register_failure(
+                            self, 'orders', job.remote_id, 'Order not found'
+                        )
+
+                self.commit_prestashop_import()
+                self.end_prestashop_page()
+        return sales
+
+    def enqueue_prestashop_orders(self):
+        """
+        Add a job for every order updated on the site since the last import
+        time, to be imported by the workers
+
+        :returns: The list of jobs
+        """
+        ImportJob = Pool().get('prestashop.import.job')
+        self.validate_prestashop_channel()
+
+        if not self.order_states:
+            self.raise_user_error('order_states_not_imported')
+
+        utc_time_now = datetime.utcnow()
+        site_tz = pytz.timezone(self.prestashop_timezone)
+        time_now = site_tz.normalize(pytz.utc.localize(utc_time_now))
+        filters, date = self.get_order_import_filters(
+            self.get_order_states_to_import(), site_tz, time_now
+        )
+
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            client = self.get_prestashop_client()
+            order_ids = [
+                order.id.pyval for order in client.iter_list(
+                    'orders', display=['id'], filters=filters, date=date,
+                    sort=[('id', 'ASC')]
                 )
+            ]
 
-            self.write([self], {
-                'last_order_import_time': utc_time_now
-            })
-            sales_imported = []
-            for order in orders_to_import:
+        jobs = ImportJob.enqueue(self, 'orders', order_ids)
+        self.commit_order_import_time(utc_time_now)
+        return jobs
+
+    @classmethod
+    def enqueue_orders_using_cron(cls):
+        """
+        Add the import jobs of the orders updated on the site, for every
+        prestashop channel
+        """
+        channels = cls.search([
+            ('source', '=', 'prestashop')
+        ])
+        for channel in channels:
+            channel.enqueue_prestashop_orders()
 
-                # TODO: Use import_order here
-                sales_imported.append(Sale.find_or_create_using_ps_data(order))
+    def commit_order_import_time(self, import_time):
+        """
+        Move the last order import time forward and commit the orders
+        imported so far along with it, so that an import which stops halfway
+        resumes from there
 
-        return sales_imported
+        :param import_time: Naive datetime in UTC
+        """
+        self.write([self], {
+            'last_order_import_time': import_time
+        })
+        self.commit_prestashop_import()
+
+    def commit_prestashop_import(self):
+        """
+        Commit the work of the import done so far, unless in tests or in a
+        dry run, which are rolled back
+        """
+        context = Transaction().context
+        if not context.get('ps_test') and \
+                not context.get('prestashop_dry_run'):
+            Transaction().cursor.commit()
+
+    @classmethod
+    def dry_run_prestashop_import(cls, channels):
+        """
+        Import the orders of the channels and roll the import back
+
+        :param channels: List of active records of channels
+        :returns: A list of the report of every channel, see
+                  `dry_run_import_orders`
+        """
+        return [channel.dry_run_import_orders() for channel in channels]
+
+    def dry_run_import_orders(self):
+        """
+        Run the import of the orders all the way through, measuring where
+        the time goes, then roll back the whole transaction
+
+        :returns: A dictionary with the number of orders imported, the
+                  seconds the import took, the orders imported per second,
+                  the seconds spent in every stage of the import, the
+                  number of requests sent per resource and the number of SQL
+                  queries. The time not spent in any stage is counted in
+                  the `other` stage.
+        """
+        transaction = Transaction()
+        report = RunReport()
+        try:
+            with collect(report), \
+                    count_queries(transaction.cursor, report), \
+                    transaction.set_context(prestashop_dry_run=True), \
+                    stage('other'):
+                sales = self.import_orders()
+                report.finish(len(sales))
+        finally:
+            transaction.cursor.rollback()
+
+        report = report.get_report()
+        logger.info('Dry run of the import of channel %s: %s', self.id, report)
+        return report
 
     @classmethod
     def export_orders_to_prestashop_using_cron(cls):
         """
         Export order status to prestashop using cron
+
+        Channels are exported concurrently, each in its own transaction, so
+        that a slow or failing site does not hold back the others. On
+        sqlite and in tests, they are exported one after another in the
+        current transaction.
         """
         channels = cls.search([
             ('source', '=', 'prestashop')
         ])
-        for channel in channels:
-            channel.export_orders_to_prestashop()
+        transaction = Transaction()
+        database_name = transaction.cursor.database_name
+
+        if backend.name() == 'sqlite' or transaction.context.get('ps_test'):
+            for channel in channels:
+                started, status = time.time(), 'failed'
+                try:
+                    channel.export_orders_to_prestashop()
+                    status = 'done'
+                finally:
+                    export_timings.record(
+                        (database_name, channel.id), status,
+                        time.time() - started
+                    )
+            return
+
+        global _export_pool
+        if _export_pool is None:
+            # The threads are kept, so that the webservice clients of the
+            # channels, which belong to a thread, are reused by later runs
+            _export_pool = ThreadPool(EXPORT_MAX_WORKERS)
+        _export_pool.map(cls.export_channel_orders, [(
+            database_name, transaction.user, dict(transaction.context),
+            channel.id
+        ) for channel in channels], chunksize=1)
+
+    @classmethod
+    def export_channel_orders(cls, args):
+        """
+        Export the order states of a channel in a new transaction, unless
+        another transaction is exporting the channel. Errors are logged and
+        do not stop the export of the other channels.
+
+        As in the cron, the caches of the thread are cleaned of the changes
+        made by other processes when the transaction starts, and the changes
+        made by the transaction are told to the other processes once it
+        ended.
+
+        :param args: A tuple of the database name, user ID, context and
+                     channel ID
+        """
+        database_name, user, context, channel_id = args
+
+        started, status = time.time(), 'failed'
+        with Transaction().start(database_name, user, context=context) as txn:
+            Cache.clean(database_name)
+            try:
+                if cls.lock_prestashop_channel(channel_id):
+                    cls(channel_id).export_orders_to_prestashop()
+                    txn.cursor.commit()
+                    status = 'done'
+                else:
+                    logger.info(
+                        'Export of channel %s skipped, it is being exported '
+                        'by another transaction', channel_id
+                    )
+                    status = 'skipped'
+            except Exception:
+                logger.exception('Export of channel %s failed', channel_id)
+                txn.cursor.rollback()
+            Cache.resets(database_name)
+        export_timings.record(
+            (database_name, channel_id), status, time.time() - started
+        )
+
+    @staticmethod
+    def lock_prestashop_channel(channel_id):
+        """
+        Lock the channel until the end of the transaction
+
+        :param channel_id: ID of the channel
+        :returns: False if the channel is locked by another transaction
+        """
+        if backend.name() != 'postgresql':
+            return True
+        cursor = Transaction().cursor
+        cursor.execute(
+            'SELECT pg_try_advisory_xact_lock(%s, %s)',
+            (CHANNEL_LOCK_CLASS, channel_id)
+        )
+        return cursor.fetchone()[0]
+
+    def get_prestashop_export_stats(self):
+        """
+        Return the duration and outcome of the exports of the channel run by
+        the cron of this process, or None if it did not run
+        """
+        return export_timings.get_stats(
+            (Transaction().cursor.database_name, self.id)
+        )
 
     @classmethod
     @ModelView.button_action('prestashop.wizard_prestashop_export_orders')
@@ -324,50 +1390,104 @@ class Channel:
         :returns: The list of active records of sales exported
         """
         Sale = Pool().get('sale.sale')
-        Move = Pool().get('stock.move')
 
         if not self.order_states:
             self.raise_user_error('order_states_not_imported')
 
-        time_now = datetime.utcnow()
-
         self.validate_prestashop_channel()
 
-        with Transaction().set_context(current_channel=self.id):
-            if self.last_order_export_time:
-                # Sale might not get updated for state changes in the related
-                # shipments.
-                # So first get the moves for outgoing shipments which are \
-                # executed after last import time.
-                moves = Move.search([
-                    (
-                        'write_date', '>=',
-                        self.last_order_export_time
-                    ),
-                    ('sale.channel', '=', self.id),
-                    ('shipment', 'like', 'stock.shipment.out%')
-                ])
-                sales_to_export = Sale.search(['OR', [
-                    (
-                        'write_date', '>=',
-                        self.last_order_export_time
-                    ),
-                    ('channel', '=', self.id),
-                ], [
-                    ('id', 'in', map(int, [m.sale for m in moves]))
-                ]])
-            else:
-                sales_to_export = Sale.search([('channel', '=', self.id)])
-
+        with Transaction().set_context(current_channel=self.id), \
+                self.prestashop_run():
+            sales_to_export = Sale.browse(Sale.get_ps_changed_sale_ids(
+                self, self.last_order_export_time
+            ))
+
+            report = RunReport()
+            with collect(report):
+                sent = self.export_prestashop_order_states(sales_to_export)
+            report.finish(len(sent))
+
+            # The time is taken once the states sent are stored, as storing
+            # them changes the write date of the sales, which would list
+            # them again on the next export. It is stored without its
+            # microseconds, so it is rounded up to the next second.
+            time_now = datetime.utcnow()
+            if time_now.microsecond:
+                time_now = time_now.replace(microsecond=0) + \
+                    timedelta(seconds=1)
             self.write([self], {
                 'last_order_export_time': time_now
             })
-
-            for sale in sales_to_export:
-                sale.export_order_status_to_prestashop()
+            logger.info(
+                'Export of the order states of channel %s: %s',
+                self.id, report.get_report()
+            )
 
         return sales_to_export
 
+    def export_prestashop_order_states(self, sales):
+        """
+        Send the states of the sales which changed to prestashop
+
+        A state is sent by adding a record to the history of the order. If
+        the site refuses it, the whole order is sent back with its new state
+        instead, see `sale.sale.export_order_status_to_prestashop`. Any
+        other error of the site stops the export.
+
+        :param sales: List of active records of sales
+        :returns: The list of the sales whose state was sent
+        """
+        Sale = Pool().get('sale.sale')
+
+        # States are mapped once for all the sales
+        state_map = self.get_prestashop_state_map()
+        to_send = []
+        for sale in sales:
+            state = sale.get_prestashop_target_state(state_map)
+            if state and state != sale.last_prestashop_state:
+                to_send.append((sale, state))
+        if not to_send:
+            return []
+
+        client = self.get_prestashop_client()
+        histories = [
+            (sale.channel_identifier, target) for sale, target in to_send
+        ]
+        # Only the orders whose history was refused are sent back
+        added = client.add_order_histories(histories)
+
+        # The states added to the histories are stored with a write by state
+        sent_by_state = {}
+        for (sale, state), history_added in zip(to_send, added):
+            if history_added:
+                sent_by_state.setdefault(state, []).append(sale)
+            else:
+                sale.export_order_status_to_prestashop(state_map)
+        for state, sent in sent_by_state.iteritems():
+            Sale.write(sent, {'last_prestashop_state': state})
+        return [sale for sale, _ in to_send]
+
+    def get_prestashop_state_map(self):
+        """
+        Return the codes of the prestashop states to which the orders are
+        moved when their sale changes state
+
+        :returns: A dictionary of the sale state to the prestashop state code
+        """
+        ChannelOrderState = Pool().get('sale.channel.order_state')
+
+        names = dict(
+            (name, state) for state, name in EXPORT_STATE_NAMES.iteritems()
+        )
+        order_states = ChannelOrderState.search([
+            ('channel', '=', self.id),
+            ('name', 'in', names.keys()),
+        ])
+        return dict(
+            (names[order_state.name], order_state.code)
+            for order_state in order_states
+        )
+
     def import_product(self, order_row_record, product_data=None):
         """
         Import specific product for this prestashop channel
@@ -398,15 +1518,10 @@ class Channel:
                 )
             sku = product_data.reference.pyval
 
-        products = Product.search([
-            ('code', '=', sku),
-        ])
-        listings = Listing.search([
-            ('product_identifier', '=', sku),
-            ('channel', '=', self)
-        ])
+        sku = unicode(sku)
+        product_id, listing_id = self.get_prestashop_sku(sku)
 
-        if not products or not listings:
+        if not product_id or not listing_id:
             # XXX: Fetch product data if it is not already being fetched
             if not product_data and \
                     order_row_record.product_attribute_id.pyval != 0:
@@ -420,15 +1535,15 @@ class Channel:
                     order_row_record.product_id.pyval
                 )
 
-            if not products:
+            if not product_id:
                 product = Product.create_from(self, product_data)
             else:
-                product = products[0]
+                product = Product(product_id)
 
-            if not listings:
+            if not listing_id:
                 Listing.create_from(self, product_data)
         else:
-            product = products[0]
+            product = Product(product_id)
 
         return product
 
@@ -469,6 +1584,23 @@ class Channel:
             }
 
 
+class ChannelException:
+    """
+    Channel Exception model
+    """
+    __name__ = 'channel.exception'
+
+    @classmethod
+    def models_get(cls):
+        """
+        Allow the channel as origin, for the orders which could not be
+        imported and so have no sale
+        """
+        return super(ChannelException, cls).models_get() + [
+            ('sale.channel', 'Channel'),
+        ]
+
+
 class PrestashopConnectionWizardView(ModelView):
     'Prestashop Connection Wizard View'
     __name__ = 'prestashop.connection.wizard.view'
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+    job
+
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+
+__all__ = [
+    'QueueMixin', 'ImportJob', 'savepoint', 'has_savepoints',
+    'get_retry_delay',
+]
+
+#: Delay before the first retry of a failed job, in seconds. The delay is
+#: doubled on every attempt.
+RETRY_DELAY = 5 * 60
+
+#: Longest delay between two retries, in seconds
+RETRY_MAX_DELAY = 24 * 60 * 60
+
+#: Number of attempts after which a failed job is no longer retried
+MAX_ATTEMPTS = 10
+
+#: Number of jobs claimed at once by a worker
+JOB_BATCH_SIZE = 100
+
+
+def get_retry_delay(attempts):
+    """
+    Return the delay before the next attempt of a failed job
+
+    :param attempts: Number of failed attempts
+    :returns: A timedelta
+    """
+    return timedelta(seconds=min(
+        RETRY_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY
+    ))
+
+
+def has_savepoints():
+    """
+    Return True if a part of the transaction can be rolled back
+
+    The sqlite driver commits the transaction before a savepoint, so
+    savepoints are only used on postgresql.
+    """
+    return backend.name() == 'postgresql'
+
+
+@contextmanager
+def savepoint(name):
+    """
+    Roll back the changes made in the block if it raises an exception, and
+    keep the changes made before it
+
+    :param name: Name of the savepoint
+    """
+    cursor = Transaction().cursor
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        # Records read in the block may have been rolled back
+        for cache in cursor.cache.itervalues():
+            cache.clear()
+        raise
+    cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+class QueueMixin(object):
+    """
+    Mixin of the models whose rows are claimed by workers
+
+    A worker claims the rows which are due by locking them, and skips the
+    rows locked by the other workers, so that a queue can be drained by
+    many workers at once. A row which failed is claimed again after a
+    delay, which doubles on every failure.
+
+    The model has the `attempts`, `next_attempt` and `last_error` fields.
+    """
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def get_delay(attempts):
+        """
+        Return the delay before the next attempt
+
+        :param attempts: Number of failed attempts
+        :returns: A timedelta
+        """
+        return get_retry_delay(attempts)
+
+    @classmethod
+    def claim_due(cls, table, where=None, order_by=None, limit=JOB_BATCH_SIZE):
+        """
+        Lock and return the rows which are due. The rows locked by another
+        transaction are skipped, and stay locked until the end of the
+        current transaction.
+
+        :param table: Table of the model, on which `where` and `order_by`
+                      are built
+        :param where: Condition on the rows to claim besides being due
+        :param order_by: Order in which the rows are claimed
+        :param limit: Number of rows to claim
+        :returns: The list of rows claimed
+        """
+        cursor = Transaction().cursor
+
+        condition = (
+            (table.next_attempt <= datetime.utcnow()) &
+            (table.attempts < MAX_ATTEMPTS)
+        )
+        if where is not None:
+            condition &= where
+        query = table.select(
+            table.id, where=condition, order_by=order_by, limit=limit
+        )
+        sql, params = tuple(query)
+        if backend.name() == 'postgresql':
+            sql += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(sql, params)
+        return cls.browse([row[0] for row in cursor.fetchall()])
+
+    def set_failure(self, error, now):
+        """
+        Count a failed attempt of the row and delay the next one. The row
+        is not saved.
+
+        :param error: The exception raised or a message
+        :param now: Time of the failure
+        """
+        self.attempts = (self.attempts or 0) + 1
+        self.next_attempt = now + self.get_delay(self.attempts)
+        self.last_error = unicode(getattr(error, 'message', None) or error)
+
+
+class ImportJob(QueueMixin, ModelSQL):
+    """Prestashop import job
+
+    A record of the site to import. Jobs are added by a cron which only
+    lists the records changed on the site, and imported by worker crons.
+    A worker claims the jobs it imports by locking their rows, and skips
+    the rows locked by the other workers, so that the queue can be drained
+    by many workers at once without importing a record twice.
+
+    A job which failed is claimed again after a delay, which doubles on
+    every failure.
+    """
+    __name__ = 'prestashop.import.job'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    resource = fields.Char('Resource', required=True)
+    remote_id = fields.Integer('Prestashop ID', required=True)
+    status = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'Status', required=True, select=True)
+    attempts = fields.Integer('Attempts', required=True)
+    next_attempt = fields.DateTime('Next Attempt', required=True, select=True)
+    started_at = fields.DateTime('Started At')
+    finished_at = fields.DateTime('Finished At')
+    last_error = fields.Text('Last Error')
+
+    @classmethod
+    def __setup__(cls):
+        super(ImportJob, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'channel_resource_remote_id_uniq',
+                'UNIQUE(channel, resource, remote_id)',
+                'Import job must be unique by channel and record'
+            )
+        ]
+        cls._order.insert(0, ('next_attempt', 'ASC'))
+
+    @staticmethod
+    def default_status():
+        return 'pending'
+
+    @classmethod
+    def enqueue(cls, channel, resource, remote_ids):
+        """
+        Add jobs to import the records. A record which already has a job is
+        imported again, and its failures are forgotten.
+
+        :param channel: Active record of the channel
+        :param resource: Name of the resource, eg: 'orders'
+        :param remote_ids: IDs of the records on prestashop
+        :returns: The list of jobs
+        """
+        remote_ids = set(remote_ids)
+        if not remote_ids:
+            return []
+
+        now = datetime.utcnow()
+        jobs = cls.search([
+            ('channel', '=', channel.id),
+            ('resource', '=', resource),
+            ('remote_id', 'in', list(remote_ids)),
+        ])
+        if jobs:
+            cls.write(jobs, {
+                'status': 'pending',
+                'attempts': 0,
+                'next_attempt': now,
+                'last_error': None,
+            })
+        remote_ids -= set(job.remote_id for job in jobs)
+        return jobs + cls.create([{
+            'channel': channel.id,
+            'resource': resource,
+            'remote_id': remote_id,
+            'next_attempt': now,
+        } for remote_id in sorted(remote_ids)])
+
+    @classmethod
+    def claim(cls, channel, resource, limit=JOB_BATCH_SIZE):
+        """
+        Lock and return the jobs of the channel which are due. The jobs
+        locked by another transaction are skipped, and stay locked until
+        the end of the current transaction.
+
+        :param channel: Active record of the channel
+        :param resource: Name of the resource, eg: 'orders'
+        :param limit: Number of jobs to claim
+        :returns: The list of jobs claimed
+        """
+        table = cls.__table__()
+
+        jobs = cls.claim_due(
+            table,
+            where=(
+                (table.channel == channel.id) &
+                (table.resource == resource) &
+                table.status.in_(['pending', 'failed'])
+            ),
+            order_by=[table.next_attempt.asc, table.id.asc],
+            limit=limit,
+        )
+        if jobs:
+            cls.write(jobs, {'started_at': datetime.utcnow()})
+        return jobs
+
+    @classmethod
+    def mark_done(cls, channel, resource, remote_ids):
+        """
+        Mark the jobs of the records as done
+
+        :param channel: Active record of the channel
+        :param resource: Name of the resource, eg: 'orders'
+        :param remote_ids: IDs of the records on prestashop
+        """
+        if not remote_ids:
+            return
+        jobs = cls.search([
+            ('channel', '=', channel.id),
+            ('resource', '=', resource),
+            ('remote_id', 'in', remote_ids),
+            ('status', '!=', 'done'),
+        ])
+        if jobs:
+            cls.write(jobs, {
+                'status': 'done',
+                'finished_at': datetime.utcnow(),
+                'last_error': None,
+            })
+
+    @classmethod
+    def register_failure(cls, channel, resource, remote_id, error):
+        """
+        Record that the record could not be imported and log an exception
+        on the channel
+
+        :param channel: Active record of the channel
+        :param resource: Name of the resource, eg: 'orders'
+        :param remote_id: ID of the record on prestashop
+        :param error: The exception raised or a message
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        jobs = cls.search([
+            ('channel', '=', channel.id),
+            ('resource', '=', resource),
+            ('remote_id', '=', remote_id),
+        ])
+        if jobs:
+            job, = jobs
+        else:
+            job = cls(channel=channel, resource=resource, remote_id=remote_id)
+            job.attempts = 0
+        now = datetime.utcnow()
+        job.status = 'failed'
+        job.set_failure(error, now)
+        job.finished_at = now
+        job.save()
+
+        ChannelException.create([{
+            'log': 'Prestashop %s %s could not be imported: %s' % (
+                resource, remote_id, job.last_error
+            ),
+            'origin': '%s,%s' % (channel.__name__, channel.id),
+            'channel': channel.id,
+        }])
+
+    @classmethod
+    def process_jobs_using_cron(cls):
+        """
+        Import the orders of the jobs which are due, for every prestashop
+        channel
+        """
+        Channel = Pool().get('sale.channel')
+
+        for channel in Channel.search([('source', '=', 'prestashop')]):
+            channel.process_prestashop_import_jobs()
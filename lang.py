@@ -61,6 +61,14 @@ class SiteLanguage(ModelSQL, ModelView):
 
         return cls.search([('channel', '=', channel.id)])
 
+    @classmethod
+    def get_ps_fields(cls):
+        """
+        Return the fields of the prestashop languages read by
+        `create_using_ps_data`. Return None to read the full records.
+        """
+        return ['id', 'name', 'language_code']
+
     @classmethod
     def search_using_ps_id(cls, prestashop_id):
         """
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    outbox
+
+"""
+import logging
+from datetime import datetime
+from itertools import groupby
+
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+from job import (
+    QueueMixin, MAX_ATTEMPTS, JOB_BATCH_SIZE, savepoint, has_savepoints
+)
+
+
+__all__ = ['OrderStateOutbox']
+logger = logging.getLogger(__name__)
+
+
+class OrderStateOutbox(QueueMixin, ModelSQL):
+    """Prestashop order state outbox
+
+    A sale whose state must be sent to prestashop. A row is written in the
+    transaction which moves the sale to a new state, so that the change is
+    sent if and only if it is committed. The rows are sent in batches by a
+    worker cron, which deletes them once sent.
+
+    Rows are only ever inserted by the transitions, never updated, so that
+    a transition never waits for a worker which holds the rows it sends. A
+    sale which changed state many times has many rows, and its state is
+    sent once for all of them: the state sent is the one of the sale when
+    the rows are drained. Sending it twice is harmless as the state last
+    sent is kept on the sale.
+    """
+    __name__ = 'prestashop.order.outbox'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, ondelete='CASCADE'
+    )
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    attempts = fields.Integer('Attempts', required=True)
+    next_attempt = fields.DateTime('Next Attempt', required=True, select=True)
+    last_error = fields.Text('Last Error')
+
+    @classmethod
+    def __setup__(cls):
+        super(OrderStateOutbox, cls).__setup__()
+        cls._order.insert(0, ('next_attempt', 'ASC'))
+
+    @classmethod
+    def enqueue(cls, sales):
+        """
+        Add a row for every sale of a prestashop channel to the outbox, even
+        if the sale is in the outbox already
+
+        :param sales: List of active records of sales
+        :returns: The list of rows
+        """
+        sales = dict(
+            (sale.id, sale) for sale in sales
+            if sale.channel and sale.channel.source == 'prestashop' and
+            sale.channel_identifier
+        )
+        now = datetime.utcnow()
+        return cls.create([{
+            'sale': sale.id,
+            'channel': sale.channel.id,
+            'next_attempt': now,
+        } for sale in sales.itervalues()])
+
+    @classmethod
+    def claim(cls, limit=JOB_BATCH_SIZE):
+        """
+        Lock and return the rows which are due. The rows locked by another
+        transaction are skipped, and stay locked until the end of the
+        current transaction.
+
+        :param limit: Number of rows to claim
+        :returns: The list of rows claimed
+        """
+        table = cls.__table__()
+
+        return cls.claim_due(
+            table, order_by=[table.channel.asc, table.next_attempt.asc],
+            limit=limit,
+        )
+
+    @classmethod
+    def drain(cls, limit=JOB_BATCH_SIZE):
+        """
+        Send the states of a batch of the sales which are due, once for all
+        the rows of a sale, and delete the rows sent. Only the rows claimed
+        are deleted, a row added meanwhile is sent by the next batch. The
+        rows of a channel which failed are sent again after a delay, which
+        doubles on every failure.
+
+        :param limit: Number of rows to send
+        :returns: The number of rows claimed
+        """
+        rows = cls.claim(limit)
+        for channel, channel_rows in groupby(rows, lambda r: r.channel):
+            channel_rows = list(channel_rows)
+            # A sale is sent once for all its rows
+            sales = dict((row.sale.id, row.sale) for row in channel_rows)
+            try:
+                # A database error only rolls back the states of the channel
+                # instead of aborting the transaction of the batch
+                if has_savepoints():
+                    with savepoint('prestashop_outbox'):
+                        cls.send(channel, sales.values())
+                else:
+                    cls.send(channel, sales.values())
+            except Exception, error:
+                logger.exception(
+                    'Order states of channel %s could not be sent', channel.id
+                )
+                cls.register_failure(channel_rows, error)
+            else:
+                cls.delete(channel_rows)
+        return len(rows)
+
+    @staticmethod
+    def send(channel, sales):
+        """
+        Send the states of the sales of the channel
+
+        :param channel: Active record of the channel
+        :param sales: List of active records of sales
+        """
+        with Transaction().set_context(current_channel=channel.id), \
+                channel.prestashop_run():
+            channel.export_prestashop_order_states(sales)
+
+    @classmethod
+    def register_failure(cls, rows, error):
+        """
+        Record that the states of the rows could not be sent. The rows
+        which failed too many times are dropped, and an exception is logged
+        on their sale.
+
+        :param rows: List of rows
+        :param error: The exception raised or a message
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        now = datetime.utcnow()
+        dropped = []
+        for row in rows:
+            row.set_failure(error, now)
+            if row.attempts >= MAX_ATTEMPTS:
+                dropped.append(row)
+            else:
+                row.save()
+        if not dropped:
+            return
+
+        ChannelException.create([{
+            'log': (
+                'State of the sale could not be sent to prestashop after '
+                '%d attempts: %s' % (row.attempts, row.last_error)
+            ),
+            'origin': '%s,%s' % (row.sale.__name__, row.sale.id),
+            'channel': row.channel.id,
+        } for row in dropped])
+        cls.delete(dropped)
+
+    @classmethod
+    def drain_using_cron(cls):
+        """
+        Send the states of the sales in the outbox, committing every batch
+        """
+        cursor = Transaction().cursor
+
+        while cls.drain() == JOB_BATCH_SIZE:
+            if not Transaction().context.get('ps_test'):
+                cursor.commit()
@@ -38,12 +38,11 @@ class Product:
         if channel.source != 'prestashop':
             return super(Product, cls).create_from(channel, product_data)
 
-        products = cls.search([
-            ('code', '=', unicode(product_data.reference.pyval)),
-        ])
-
-        if products:
-            return products[0]
+        product_id, _ = channel.get_prestashop_sku(
+            unicode(product_data.reference.pyval)
+        )
+        if product_id:
+            return cls(product_id)
 
         if product_data.tag == 'combination':
             product = cls.get_ps_combination_product(
@@ -72,6 +71,7 @@ class Product:
             'list_price': round_price(str(combination_record.price)),
             'cost_price': round_price(str(combination_record.wholesale_price)),
         }])
+        channel.set_prestashop_sku(product.code, product_id=product.id)
         return product
 
     @classmethod
@@ -139,6 +139,7 @@ class Product:
 
             template, = Template.create([template_values])
             product, = template.products
+        channel.set_prestashop_sku(product.code, product_id=product.id)
 
         # If there is only lang for name, control wont go to this loop
         for name_in_lang in name_in_langs:
@@ -195,34 +196,25 @@ class ProductSaleChannelListing:
         """
         Create a listing for the product from channel and data
         """
-        Product = Pool().get('product.product')
-
         if channel.source != 'prestashop':
             return super(ProductSaleChannelListing, cls).create_from(
                 channel, product_data
             )
 
-        try:
-            product, = Product.search([
-                ('code', '=', product_data.reference.pyval),
-            ])
-        except ValueError:
-            cls.raise_user_error("No product found for mapping")
-
         identifier = unicode(product_data.reference.pyval)
 
-        listings = cls.search([
-            ('product_identifier', '=', identifier),
-            ('channel', '=', channel)
-        ])
+        product_id, listing_id = channel.get_prestashop_sku(identifier)
 
-        if listings:
+        if listing_id:
             # XXX: Listing already exists
-            return listings[0]
+            return cls(listing_id)
+
+        if not product_id:
+            cls.raise_user_error("No product found for mapping")
 
         listing = cls(
             channel=channel,
-            product=product,
+            product=product_id,
             product_identifier=identifier,
         )
         if product_data.tag == 'combination':
@@ -230,6 +222,7 @@ class ProductSaleChannelListing:
         elif product_data.tag == 'product':
             listing.prestashop_product_id = product_data.id.pyval
         listing.save()
+        channel.set_prestashop_sku(identifier, listing_id=listing.id)
         return listing
 
     def export_inventory(self):
@@ -279,25 +272,20 @@ class ProductSaleChannelListing:
                 else:
                     product_listings[listing.prestashop_product_id] = listing
 
-            # TODO: fetch in batches
-            product_stock_objects = client.stock_availables.get_list(
-                display="full", filters={
-                    # XXX: Stock should not be managed by Prestashop
-                    'depends_on_stock': '0',
-                    'id_product': '|'.join(
-                        map(str, product_listings.keys())
-                    )
-                },
-            ) if product_listings else []
-            combination_stock_objects = client.stock_availables.get_list(
-                display="full", filters={
-                    # XXX: Stock should not be managed by Prestashop
-                    'depends_on_stock': '0',
-                    'id_product_attribute': '|'.join(
-                        map(str, combination_listings.keys())
-                    )
-                },
-            ) if combination_listings else []
+            # Stock objects are sent back to the site, so they are always
+            # read as XML and in full
+            stock_availables = client.get_xml_resource('stock_availables')
+
+            # XXX: Stock should not be managed by Prestashop
+            filters = {'depends_on_stock': '0'}
+            product_stock_objects = client.get_list_in(
+                stock_availables, 'id_product', product_listings.keys(),
+                filters=filters
+            )
+            combination_stock_objects = client.get_list_in(
+                stock_availables, 'id_product_attribute',
+                combination_listings.keys(), filters=filters
+            )
 
             for stock_obj in product_stock_objects:
                 # update product stock object with new quantity
@@ -319,4 +307,4 @@ class ProductSaleChannelListing:
             for stock_obj in (
                     combination_stock_objects + product_stock_objects):
                 # XXX: Replace this with bulk update in future.
-                client.stock_availables.update(stock_obj.id, stock_obj)
+                stock_availables.update(stock_obj.id, stock_obj)
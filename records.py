@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    records
+
+    Readers for the records sent by the prestashop webservice.
+
+"""
+import json
+
+__all__ = ['JSONRecord', 'singular_name', 'parse_json_record',
+           'parse_json_list']
+
+
+def singular_name(resource):
+    """
+    Return the name of a single record of the resource
+
+    >>> singular_name('countries')
+    'country'
+    >>> singular_name('addresses')
+    'address'
+    >>> singular_name('order_details')
+    'order_detail'
+    """
+    if resource.endswith('ies'):
+        return resource[:-3] + 'y'
+    if resource.endswith('sses'):
+        return resource[:-2]
+    if resource.endswith('s'):
+        return resource[:-1]
+    return resource
+
+
+def guess_pyval(value):
+    """
+    Return the python value of a text sent by the webservice, the same way
+    lxml objectify guesses it for the XML output
+    """
+    if not isinstance(value, basestring):
+        return value
+    if value in ('true', 'false'):
+        return value == 'true'
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class JSONRecord(object):
+    """
+    Record of the JSON output of the webservice
+
+    It gives the same access to the data as the objectified XML, i.e.,
+    children as attributes, `pyval`, `tag`, `get` for the attributes and
+    `getchildren`/`iterchildren` for lists, so that the mappers work
+    unchanged with both outputs.
+    """
+    __slots__ = ('tag', 'value', 'attrib')
+
+    def __init__(self, tag, value, attrib=None):
+        object.__setattr__(self, 'tag', tag)
+        object.__setattr__(self, 'value', value)
+        object.__setattr__(self, 'attrib', attrib or {})
+
+    def __getattr__(self, name):
+        if isinstance(self.value, dict) and name in self.value:
+            return JSONRecord(name, self.value[name])
+        raise AttributeError('no such child: %s' % name)
+
+    def __setattr__(self, name, value):
+        if not isinstance(self.value, dict):
+            raise AttributeError('cannot set child on a leaf: %s' % name)
+        if isinstance(value, JSONRecord):
+            value = value.value
+        self.value[name] = value
+
+    @property
+    def pyval(self):
+        if isinstance(self.value, (dict, list)):
+            raise AttributeError('pyval is only available on leaves')
+        return guess_pyval(self.value)
+
+    @property
+    def text(self):
+        if self.value is None or isinstance(self.value, (dict, list)):
+            return None
+        return unicode(self.value)
+
+    def get(self, key, default=None):
+        """
+        Return the attribute of the record, like the `id` of a language
+        """
+        return self.attrib.get(key, default)
+
+    def getchildren(self):
+        return list(self.iterchildren())
+
+    def iterchildren(self):
+        if isinstance(self.value, dict):
+            for key, value in self.value.iteritems():
+                yield JSONRecord(key, value)
+        elif isinstance(self.value, list):
+            tag = singular_name(self.tag)
+            for item in self.value:
+                if isinstance(item, dict) and set(item) == set(
+                        ['id', 'value']):
+                    # Value in a language
+                    yield JSONRecord(
+                        'language', item['value'], {'id': str(item['id'])}
+                    )
+                else:
+                    yield JSONRecord(tag, item)
+
+    def __str__(self):
+        return (self.text or u'').encode('utf-8')
+
+    def __unicode__(self):
+        return self.text or u''
+
+    def __int__(self):
+        return int(self.pyval)
+
+    def __float__(self):
+        return float(self.pyval)
+
+    def __nonzero__(self):
+        if isinstance(self.value, (dict, list)):
+            return True
+        return bool(self.pyval)
+
+    def __eq__(self, other):
+        if isinstance(other, JSONRecord):
+            other = other.value
+        if isinstance(self.value, (dict, list)):
+            return self.value == other
+        return self.pyval == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pyval)
+
+    def __repr__(self):
+        return '<JSONRecord %s>' % self.tag
+
+
+def parse_json_record(content):
+    """
+    Return the record in the JSON output of a single record
+
+    :param content: Body of the response
+    """
+    data = json.loads(content)
+    (tag, value), = data.items()
+    return JSONRecord(tag, value)
+
+
+def parse_json_list(resource, content):
+    """
+    Return the list of records in the JSON output of a list
+
+    :param resource: Name of the resource
+    :param content: Body of the response
+    """
+    data = json.loads(content)
+    if not data:
+        # An empty list is sent without the resource name
+        return []
+    return JSONRecord(resource, data[resource]).getchildren()
@@ -7,12 +7,19 @@ from datetime import datetime
 from decimal import Decimal
 
 import pytz
+from sql import Cast, Null, Union
+from sql.conditionals import Case
+from sql.functions import Substring
 
+from trytond import backend
+from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 
+from timing import stage
 
-__all__ = ['Sale', 'SaleLine']
+
+__all__ = ['Sale', 'SaleLine', 'Move', 'ShipmentOut']
 __metaclass__ = PoolMeta
 
 
@@ -20,6 +27,12 @@ class Sale:
     "Sale"
     __name__ = 'sale.sale'
 
+    #: Code of the state of the order on prestashop when it was last
+    #: imported or exported. A state equal to it is not sent again.
+    last_prestashop_state = fields.Char(
+        'Last Prestashop State', readonly=True
+    )
+
     @classmethod
     def __setup__(cls):
         "Setup"
@@ -30,33 +43,207 @@ class Sale:
         })
 
     @classmethod
-    def find_or_create_using_ps_data(cls, order_record):
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        # Orders are looked up by channel and remote ID on every import
+        table.index_action(['channel', 'channel_identifier'], 'add')
+        # Sales changed since the last export are looked up on every export
+        table.index_action(['channel', 'write_date'], 'add')
+
+    @classmethod
+    def get_ps_changed_sale_ids(cls, channel, since=None):
+        """
+        Return the IDs of the sales of the channel which changed since the
+        given time, or whose outgoing moves were created or changed since
+        then, as the sale is not written when its shipments move on
+
+        The IDs are read with one query, without reading the moves.
+
+        :param channel: Active record of the channel
+        :param since: Naive datetime in UTC. All the sales of the channel
+                      are returned if None.
+        :returns: A list of sale IDs
+        """
+        Line = Pool().get('sale.line')
+        Move = Pool().get('stock.move')
+        cursor = Transaction().cursor
+
+        sale = cls.__table__()
+        if since is None:
+            cursor.execute(*sale.select(
+                sale.id, where=sale.channel == channel.id
+            ))
+            return [row[0] for row in cursor.fetchall()]
+
+        line = Line.__table__()
+        move = Move.__table__()
+
+        # The line is the origin of the move, stored as 'sale.line,<id>'
+        prefix = 'sale.line,'
+        line_id = Case(
+            (
+                move.origin.like(prefix + '%'),
+                Cast(
+                    Substring(move.origin, len(prefix) + 1),
+                    Move.id.sql_type().base
+                )
+            ),
+            else_=Null
+        )
+        moved = move.join(
+            line, condition=line.id == line_id
+        ).join(
+            sale, condition=sale.id == line.sale
+        ).select(
+            line.sale,
+            where=(
+                # Moves are written when they change state, but the moves
+                # added to a shipment are only created
+                ((move.write_date >= since) | (move.create_date >= since)) &
+                move.shipment.like('stock.shipment.out,%') &
+                (sale.channel == channel.id)
+            )
+        )
+        changed = sale.select(
+            sale.id,
+            where=(sale.channel == channel.id) & (sale.write_date >= since)
+        )
+
+        # The union drops the sales found twice
+        cursor.execute(*Union(changed, moved))
+        return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def get_ps_order_fields(cls):
+        """
+        Return the fields of the prestashop orders read by
+        `create_using_ps_data`. Return None to read the full records, e.g.,
+        when a custom module needs more of the order.
+        """
+        return [
+            'id', 'reference', 'current_state', 'date_add', 'date_upd',
+            'id_customer', 'id_address_invoice', 'id_address_delivery',
+            'id_currency', 'total_shipping', 'total_shipping_tax_excl',
+            'total_discounts', 'total_discounts_tax_excl',
+            'total_paid_tax_excl',
+        ]
+
+    @classmethod
+    def get_ps_order_rows(cls, order_ids):
+        """
+        Read the rows of the given orders from their order details
+
+        :param order_ids: List of prestashop order IDs
+        :returns: A dictionary of the order ID to the list of order_details
+                  records of the order
+        """
+        SaleChannel = Pool().get('sale.channel')
+        Line = Pool().get('sale.line')
+
+        if not order_ids:
+            return {}
+
+        channel = SaleChannel(Transaction().context['current_channel'])
+        client = channel.get_prestashop_client()
+
+        rows_by_order = {}
+        fields = Line.get_ps_order_row_fields()
+        for order_details in client.get_list_in(
+                'order_details', 'id_order', order_ids,
+                fields=fields and fields + ['id_order']):
+            rows_by_order.setdefault(
+                order_details.id_order.pyval, []
+            ).append(order_details)
+        return rows_by_order
+
+    @classmethod
+    def find_or_create_using_ps_data(cls, order_record, order_rows=None):
         """Look for the sale in tryton corresponding to the order_record.
         If found, return the same else create a new one and return that.
 
         :param product_record: Objectified XML record sent by pystashop
+        :param order_rows: List of order_details records of the order, if
+                           the order was read without its associations
         :returns: Active record of created sale
         """
         sale = cls.get_order_using_ps_data(order_record)
 
         if not sale:
-            sale = cls.create_using_ps_data(order_record)
+            sale = cls.create_using_ps_data(order_record, order_rows)
 
         return sale
 
     @classmethod
-    def create_using_ps_data(cls, order_record):
+    def create_using_ps_data(cls, order_record, order_rows=None):
         """Create an order from the order record sent by prestashop client
 
         :param order_record: Objectified XML record sent by pystashop
+        :param order_rows: List of order_details records of the order. If
+                           not given, the rows are taken from the
+                           associations of the order, and the details of
+                           the rows which miss some data of their line are
+                           fetched.
         :returns: Active record of created sale
         """
+        sale, = cls.create_all_using_ps_data([order_record], [order_rows])
+        return sale
+
+    @classmethod
+    def create_all_using_ps_data(cls, order_records, order_rows=None):
+        """Create the orders from the order records sent by prestashop client
+        with a single create, then move them to the state of the orders on
+        prestashop with one call of every transition for the orders of the
+        same state, see `process_all_to_channel_state`
+
+        :param order_records: List of objectified XML records sent by
+                              pystashop
+        :param order_rows: List of the order rows of every order, see
+                           `create_using_ps_data`. None stands for the
+                           rows of all the orders.
+        :returns: List of active records of the created sales
+        """
+        if order_rows is None:
+            order_rows = [None] * len(order_records)
+
+        sales_data = [
+            cls.get_sale_data_using_ps_data(order_record, rows)
+            for order_record, rows in zip(order_records, order_rows)
+        ]
+        with stage('create'):
+            sales = cls.create(sales_data)
+
+        sales_to_process, channel_states = [], []
+        for sale, order_record in zip(sales, order_records):
+            if not sale.check_ps_order_total(order_record):
+                continue
+            sales_to_process.append(sale)
+            channel_states.append(
+                unicode(order_record.current_state.pyval)  # State is int
+            )
+        with stage('workflow'):
+            cls.process_all_to_channel_state(sales_to_process, channel_states)
+        return sales
+
+    @classmethod
+    def get_sale_data_using_ps_data(cls, order_record, order_rows=None):
+        """Return the values to create the sale of the order record sent by
+        prestashop client
+
+        :param order_record: Objectified XML record sent by pystashop
+        :param order_rows: List of order_details records of the order, see
+                           `create_using_ps_data`
+        :returns: Dictionary of values of the sale
+        """
         Party = Pool().get('party.party')
         Address = Pool().get('party.address')
         Line = Pool().get('sale.line')
         SaleChannel = Pool().get('sale.channel')
         Currency = Pool().get('currency.currency')
-        ChannelException = Pool().get('channel.exception')
 
         channel = SaleChannel(Transaction().context['current_channel'])
 
@@ -66,10 +253,50 @@ class Sale:
         if not client:
             cls.raise_user_error('prestashop_site_not_found')
 
-        party = Party.find_or_create_using_ps_data(
-            client.customers.get(order_record.id_customer.pyval)
+        # Fetch all the remote records needed for this order at once
+        calls = [
+            ('customers', order_record.id_customer.pyval),
+            ('addresses', order_record.id_address_invoice.pyval),
+            ('addresses', order_record.id_address_delivery.pyval),
+        ]
+        if order_rows is None:
+            order_rows = list(
+                order_record.associations.order_rows.iterchildren()
+            )
+        # The details of the rows which miss the data of their line are
+        # read together
+        calls.extend(
+            ('order_details', order_row.id.pyval) for order_row in order_rows
+            if not Line.has_ps_line_data(order_row)
+        )
+        records = client.fetch_many(calls)
+        # Other rows are their own details
+        records.update(
+            (('order_details', order_row.id.pyval), order_row)
+            for order_row in order_rows if Line.has_ps_line_data(order_row)
         )
 
+        # The records of an order imported with its page were prefetched
+        # with the page already
+        if client.run_cache is None or \
+                not client.run_cache.is_prefetched(order_record.id.pyval):
+            channel.prefetch_prestashop_records(
+                addresses=[
+                    records[(
+                        'addresses', order_record.id_address_invoice.pyval
+                    )],
+                    records[(
+                        'addresses', order_record.id_address_delivery.pyval
+                    )],
+                ],
+                order_rows=order_rows,
+            )
+
+        with stage('party'):
+            party = Party.find_or_create_using_ps_data(
+                records[('customers', order_record.id_customer.pyval)]
+            )
+
         # Get the sale date and convert the time to UTC from the application
         # timezone set on channel
         sale_time = datetime.strptime(
@@ -78,14 +305,15 @@ class Sale:
         channel_tz = pytz.timezone(channel.prestashop_timezone)
         sale_time_utc = pytz.utc.normalize(channel_tz.localize(sale_time))
 
-        inv_address = Address.find_or_create_for_party_using_ps_data(
-            party,
-            client.addresses.get(order_record.id_address_invoice.pyval),
-        )
-        ship_address = Address.find_or_create_for_party_using_ps_data(
-            party,
-            client.addresses.get(order_record.id_address_delivery.pyval),
-        )
+        with stage('party'):
+            inv_address = Address.find_or_create_for_party_using_ps_data(
+                party,
+                records[('addresses', order_record.id_address_invoice.pyval)],
+            )
+            ship_address = Address.find_or_create_for_party_using_ps_data(
+                party,
+                records[('addresses', order_record.id_address_delivery.pyval)],
+            )
         sale_data = {
             'reference': str(order_record.id.pyval),
             'channel_identifier': str(order_record.id.pyval),
@@ -103,14 +331,19 @@ class Sale:
             unicode(order_record.current_state.pyval)  # current state is int
         )
 
+        sale_data['last_prestashop_state'] = \
+            unicode(order_record.current_state.pyval)
         sale_data['invoice_method'] = tryton_action['invoice_method']
         sale_data['shipment_method'] = tryton_action['shipment_method']
         sale_data['channel'] = channel.id
 
         lines_data = []
-        for order_line in order_record.associations.order_rows.iterchildren():
+        for order_line in order_rows:
             lines_data.append(
-                Line.get_line_data_using_ps_data(order_line)
+                Line.get_line_data_using_ps_data(
+                    order_line,
+                    records[('order_details', order_line.id.pyval)]
+                )
             )
 
         if Decimal(str(order_record.total_shipping)):
@@ -123,28 +356,110 @@ class Sale:
             )
 
         sale_data['lines'] = [('create', lines_data)]
+        return sale_data
 
-        sale, = cls.create([sale_data])
+    def check_ps_order_total(self, order_record):
+        """Check that the total of the sale matches the total of the order on
+        prestashop, and create a channel exception if it does not
 
-        # Create channel exception if order total does not match
-        if sale.total_amount != Decimal(
+        :param order_record: Objectified XML record sent by pystashop
+        :returns: True if the totals match
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        if self.total_amount == Decimal(
             str(order_record.total_paid_tax_excl)
         ):
-            ChannelException.create([{
-                'origin': '%s,%s' % (sale.__name__, sale.id),
-                'log': 'Order total does not match. Expected %s, found %s' % (
-                    sale.total_amount, Decimal(
-                        str(order_record.total_paid_tax_excl))
-                ),
-                'channel': sale.channel.id,
-            }])
-
-            return sale
-
-        sale.process_to_channel_state(
-            unicode(order_record.current_state.pyval)  # Current state is int
-        )
-        return sale
+            return True
+
+        ChannelException.create([{
+            'origin': '%s,%s' % (self.__name__, self.id),
+            'log': 'Order total does not match. Expected %s, found %s' % (
+                self.total_amount, Decimal(
+                    str(order_record.total_paid_tax_excl))
+            ),
+            'channel': self.channel.id,
+        }])
+        return False
+
+    @classmethod
+    def process_all_to_channel_state(cls, sales, channel_states):
+        """Process the sales to the states of their orders on the channel,
+        with one call of `process_group_to_channel_state` for the sales of
+        a channel with the same state
+
+        :param sales: List of active records of sales
+        :param channel_states: List of the state of every sale on the channel
+        """
+        groups = {}
+        for sale, channel_state in zip(sales, channel_states):
+            groups.setdefault(
+                (sale.channel.id, channel_state), []
+            ).append(sale)
+
+        for (_, channel_state), group in sorted(groups.iteritems()):
+            cls.process_group_to_channel_state(group, channel_state)
+
+    @classmethod
+    def process_group_to_channel_state(cls, sales, channel_state):
+        """Process the sales of a channel to the same state on the channel
+        like `process_to_channel_state`, but with one call of every
+        transition for all of them
+
+        Modules which change the workflow of the imported sales by
+        overriding `process_to_channel_state` override this method too.
+
+        :param sales: List of active records of sales of the same channel
+        :param channel_state: State of the sales on the channel
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        if not sales:
+            return
+        data = sales[0].channel.get_tryton_action(channel_state)
+        sale_ids = map(int, sales)
+
+        to_write = [
+            s for s in sales if s.state == 'draft' and (
+                s.invoice_method != data['invoice_method'] or
+                s.shipment_method != data['shipment_method']
+            )
+        ]
+        if to_write:
+            cls.write(to_write, {
+                'invoice_method': data['invoice_method'],
+                'shipment_method': data['shipment_method'],
+            })
+
+        if data['action'] in ('process_manually', 'process_automatically'):
+            cls.quote([s for s in cls.browse(sale_ids) if s.state == 'draft'])
+            cls.confirm([
+                s for s in cls.browse(sale_ids) if s.state == 'quotation'
+            ])
+
+        if data['action'] == 'process_automatically':
+            cls.process([
+                s for s in cls.browse(sale_ids) if s.state == 'confirmed'
+            ])
+            shipments = [
+                shipment for sale in cls.browse(sale_ids)
+                for shipment in sale.shipments
+            ]
+            Shipment.wait([s for s in shipments if s.state == 'draft'])
+            # Stock is assigned shipment by shipment, as a shipment which
+            # cannot be assigned would prevent the others in a group
+            for shipment in Shipment.browse(map(int, shipments)):
+                if shipment.state == 'waiting':
+                    Shipment.assign_try([shipment])
+
+        to_import_as_past = [
+            s for s in cls.browse(sale_ids) if s.state == 'draft'
+        ] if data['action'] == 'import_as_past' else []
+        if to_import_as_past:
+            # XXX: mark past orders as completed
+            cls.write(to_import_as_past, {'state': 'done'})
+            # Update cached values
+            cls.store_cache(to_import_as_past)
 
     @classmethod
     def get_order_using_ps_data(cls, order_record):
@@ -161,42 +476,108 @@ class Sale:
 
         return sales and sales[0] or None
 
-    def export_order_status_to_prestashop(self):
+    @classmethod
+    def get_orders_using_ps_data(cls, order_records):
+        """Find the existing orders in Tryton which match the given
+        order_records with a single query. By default it just matches the
+        channel_identifier, like `get_order_using_ps_data`.
+
+        :param order_records: List of objectified XML records sent by
+                              prestashop
+        :returns: A dictionary of the prestashop order ID to the active
+                  record of the sale found
+        """
+        if not order_records:
+            return {}
+
+        sales = cls.search([
+            ('channel_identifier', 'in', [
+                unicode(order_record.id.pyval)
+                for order_record in order_records
+            ]),
+            ('channel', '=', Transaction().context.get('current_channel'))
+        ])
+        return dict(
+            (int(sale.channel_identifier), sale) for sale in sales
+        )
+
+    @classmethod
+    def cancel(cls, sales):
+        states = dict((sale.id, sale.state) for sale in sales)
+        super(Sale, cls).cancel(sales)
+        cls.enqueue_changed_states(sales, states)
+
+    @classmethod
+    def do(cls, sales):
+        states = dict((sale.id, sale.state) for sale in sales)
+        super(Sale, cls).do(sales)
+        cls.enqueue_changed_states(sales, states)
+
+    @classmethod
+    def enqueue_changed_states(cls, sales, states):
+        """Add the sales whose state changed to the prestashop outbox. The
+        sales which a transition skipped are left out.
+
+        :param sales: List of active records of sales
+        :param states: Dictionary of the sale ID to the state of the sale
+                       before the transition
+        """
+        Pool().get('prestashop.order.outbox').enqueue([
+            sale for sale in cls.browse(map(int, sales))
+            if sale.state != states[sale.id]
+        ])
+
+    def get_prestashop_target_state(self, state_map=None):
+        """Return the code of the prestashop state matching the state of
+        the sale, or None if the state is not sent to prestashop
+
+        :param state_map: Dictionary of the sale state to the prestashop
+                          state code, see
+                          `sale.channel.get_prestashop_state_map`. It is
+                          built for the channel of the sale if not given.
+        """
+        if state_map is None:
+            state_map = self.channel.get_prestashop_state_map()
+        return state_map.get(self.state)
+
+    def export_order_status_to_prestashop(self, state_map=None):
         """Update the status of this order in prestashop based on the order
         state in Tryton.
 
+        Nothing is sent if the state is the one last sent to or read from
+        prestashop.
+
+        :param state_map: Dictionary of the sale state to the prestashop
+                          state code, shared by the sales exported together
+        :returns: The order sent back by prestashop, or None if nothing was
+                  sent
         """
-        ChannelOrderState = Pool().get('sale.channel.order_state')
+        new_prestashop_state = self.get_prestashop_target_state(state_map)
+
+        if not new_prestashop_state or \
+                new_prestashop_state == self.last_prestashop_state:
+            return
 
         client = self.channel.get_prestashop_client()
 
-        new_prestashop_state = None
+        # The order is sent back to the site, so it is always read as XML
+        orders = client.get_xml_resource('orders')
+        order = orders.get(self.channel_identifier)
+        if unicode(order.current_state) != new_prestashop_state:
+            order.current_state = new_prestashop_state
+            order = orders.update(order.id, order).order
 
-        if self.state == 'cancel':
-            order_state, = ChannelOrderState.search([
-                ('channel', '=', self.id),
-                ('name', '=', 'Canceled'),
-            ])
-            new_prestashop_state = order_state.code
-        elif self.state == 'done':
-            # TODO: update shipping and invoice
-            order_state, = ChannelOrderState.search([
-                ('channel', '=', self.id),
-                # XXX: Though final state in prestashop is delivered, but
-                # till we don't have provision to get delivery status, set
-                # it to shipped.
-                ('name', '=', 'Shipped'),
-            ])
-            new_prestashop_state = order_state.code
-
-        if not new_prestashop_state:
-            return
+        self.set_last_prestashop_state(new_prestashop_state)
+        return order
 
-        order = client.orders.get(self.channel_identifier)
-        order.current_state = new_prestashop_state
-        result = client.orders.update(order.id, order)
+    def set_last_prestashop_state(self, state):
+        """Store the state last sent to prestashop. The sale is listed again
+        by the next export as it was written, but its state is not sent
+        again.
 
-        return result.order
+        :param state: Code of the prestashop state
+        """
+        self.write([self], {'last_prestashop_state': state})
 
 
 class SaleLine:
@@ -204,10 +585,47 @@ class SaleLine:
     __name__ = 'sale.line'
 
     @classmethod
-    def get_line_data_using_ps_data(cls, order_row_record):
+    def get_ps_line_fields(cls):
+        """
+        Return the fields of the order details read by
+        `get_line_data_using_ps_data`
+        """
+        return ['product_quantity', 'unit_price_tax_excl', 'product_name']
+
+    @classmethod
+    def get_ps_order_row_fields(cls):
+        """
+        Return the fields of the prestashop order details read by
+        `get_line_data_using_ps_data` and to find the product of the line.
+        Return None to read the full records.
+        """
+        return [
+            'id', 'product_id', 'product_attribute_id', 'product_reference',
+        ] + cls.get_ps_line_fields()
+
+    @classmethod
+    def has_ps_line_data(cls, order_row_record):
+        """
+        Check if the order row has all the data of the line, so that its
+        order details need not be read. Recent versions of prestashop send
+        them in the rows of the order.
+
+        :param order_row_record: Objectified XML record sent by pystashop
+        """
+        return all(
+            hasattr(order_row_record, field)
+            for field in cls.get_ps_line_fields()
+        )
+
+    @classmethod
+    def get_line_data_using_ps_data(cls, order_row_record, order_details=None):
         """Create the sale line from the order_row_record
 
         :param order_row_record: Objectified XML record sent by pystashop
+        :param order_details: Objectified XML order_details record of the
+                              order row. If not given, the row itself is
+                              used when it has the data of the line, else
+                              the details are fetched.
         :returns: Sale line dictionary of values
         """
         SaleChannel = Pool().get('sale.channel')
@@ -215,12 +633,17 @@ class SaleLine:
         channel = SaleChannel(Transaction().context['current_channel'])
         channel.validate_prestashop_channel()
 
-        client = channel.get_prestashop_client()
-
         # Import product
-        product = channel.get_product(order_row_record)
-
-        order_details = client.order_details.get(order_row_record.id.pyval)
+        with stage('product'):
+            product = channel.get_product(order_row_record)
+
+        if order_details is None and cls.has_ps_line_data(order_row_record):
+            order_details = order_row_record
+        elif order_details is None:
+            client = channel.get_prestashop_client()
+            order_details = client.order_details.get(
+                order_row_record.id.pyval
+            )
 
         # FIXME: The number of digits handled in unit price should actually
         # from sale currency but the sale is not created yet.
@@ -283,3 +706,38 @@ class SaleLine:
             )).quantize(Decimal(10) ** - channel.company.currency.digits),
             'description': 'Discount',
         }
+
+
+class Move:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(Move, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        # Moves changed since the last export are looked up on every export
+        table.index_action('write_date', 'add')
+        table.index_action('create_date', 'add')
+
+
+class ShipmentOut:
+    "Customer Shipment"
+    __name__ = 'stock.shipment.out'
+
+    @classmethod
+    def done(cls, shipments):
+        states = dict((shipment.id, shipment.state) for shipment in shipments)
+        super(ShipmentOut, cls).done(shipments)
+        # The sales are processed once the state of the shipments is
+        # written, their state is read when their row is sent. The
+        # shipments which were done already are left out.
+        Pool().get('prestashop.order.outbox').enqueue(list(set(
+            move.sale for shipment in cls.browse(map(int, shipments))
+            if shipment.state != states[shipment.id]
+            for move in shipment.outgoing_moves if move.sale
+        )))
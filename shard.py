@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    shard
+
+    Import of the orders of a channel split across worker processes.
+
+"""
+import sys
+import logging
+import subprocess
+import cPickle as pickle
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+#: Number of orders imported and committed at once by a process
+SHARD_PAGE_SIZE = 100
+
+#: Command run by a worker process
+WORKER_COMMAND = [
+    sys.executable, '-c',
+    'from trytond.modules.prestashop.shard import main; main()',
+]
+
+__all__ = [
+    'split_in_shards', 'run_in_processes', 'import_order_shard',
+    'ShardError',
+]
+logger = logging.getLogger(__name__)
+
+
+class ShardError(Exception):
+    """
+    A worker process did not return its result
+    """
+
+
+def split_in_shards(orders, shards):
+    """
+    Split the orders in lists of order IDs, keeping all the orders of a
+    customer in the same list so that two processes never create the same
+    party or address
+
+    :param orders: List of order records with the `id` and `id_customer`
+    :param shards: Number of lists
+    :returns: A list of lists of order IDs, without the empty ones
+    """
+    order_ids = [[] for i in range(shards)]
+    for order in orders:
+        order_ids[order.id_customer.pyval % shards].append(order.id.pyval)
+    return filter(None, order_ids)
+
+
+def run_in_processes(processes, func, args):
+    """
+    Call func on every item of args in worker processes
+
+    Every worker is a new interpreter rather than a fork, so that it does
+    not share the database connections, webservice clients and locks of
+    the threads of the current process. The workers read the configuration
+    of the current process, and open their own connections.
+
+    :param processes: Number of processes run at once
+    :param func: Function at the module level, called with every item
+    :param args: List of arguments, which must be picklable
+    :returns: The list of results
+    """
+    settings = dict(
+        (section, config.items(section)) for section in config.sections()
+    )
+    results = []
+    for start in range(0, len(args), processes):
+        workers = []
+        for arg in args[start:start + processes]:
+            worker = subprocess.Popen(
+                WORKER_COMMAND, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, close_fds=True
+            )
+            pickle.dump(
+                (settings, func.__module__, func.__name__, arg),
+                worker.stdin, pickle.HIGHEST_PROTOCOL
+            )
+            worker.stdin.close()
+            workers.append(worker)
+
+        for worker in workers:
+            output = worker.stdout.read()
+            if worker.wait() != 0:
+                raise ShardError(
+                    'Worker process exited with status %s' % worker.returncode
+                )
+            results.append(pickle.loads(output))
+    return results
+
+
+def main():
+    """
+    Entry point of a worker process: read the configuration, the function
+    and its argument sent by `run_in_processes` on the standard input, and
+    write the result on the standard output
+    """
+    logging.basicConfig()
+    settings, module, name, arg = pickle.load(sys.stdin)
+    for section, options in settings.iteritems():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options:
+            config.set(section, option, value)
+
+    # Only the result is written on the standard output
+    output, sys.stdout = sys.stdout, sys.stderr
+    func = getattr(__import__(module, fromlist=[name]), name)
+    pickle.dump(func(arg), output, pickle.HIGHEST_PROTOCOL)
+    output.flush()
+
+
+def import_order_shard(args):
+    """
+    Import the orders of a shard in a new transaction, committing every
+    page
+
+    :param args: A tuple of the database name, user ID, context, channel
+                 ID and the list of order IDs of the shard
+    :returns: The number of orders imported
+    """
+    database_name, user, context, channel_id, order_ids = args
+
+    Pool(database_name).init()
+    with Transaction().start(database_name, user, context=context) as txn:
+        Channel = Pool().get('sale.channel')
+
+        channel = Channel(channel_id)
+        imported = 0
+        for start in range(0, len(order_ids), SHARD_PAGE_SIZE):
+            page = order_ids[start:start + SHARD_PAGE_SIZE]
+            try:
+                imported += len(channel.import_prestashop_order_ids(page))
+            except Exception:
+                logger.exception(
+                    'Import of %d orders of channel %s failed',
+                    len(page), channel_id
+                )
+                txn.cursor.rollback()
+                raise
+            txn.cursor.commit()
+    return imported
@@ -10,6 +10,8 @@ from test_prestashop import TestPrestashop
 from test_party import TestParty
 from test_product import TestProduct
 from test_sale import TestSale
+from test_throttle import TestThrottle
+from test_records import TestRecords
 
 
 def suite():
@@ -20,6 +22,8 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestParty),
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestSale),
+        unittest.TestLoader().loadTestsFromTestCase(TestThrottle),
+        unittest.TestLoader().loadTestsFromTestCase(TestRecords),
     ])
     return test_suite
 
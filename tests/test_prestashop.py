@@ -19,8 +19,13 @@ if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
 from lxml import objectify
+import threading
+import time
 import unittest
 
+import requests
+from pystashop import PrestaShopWebserviceException
+
 import trytond
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
@@ -28,10 +33,101 @@ from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.config import config
+from trytond.modules.prestashop.webservice import RunCache, \
+    PrestashopClient, PrestashopSession, ClientRegistry, MAX_URL_LENGTH
+from trytond import backend
+from trytond.modules.prestashop import cache as cache_module
+from trytond.modules.prestashop.cache import ChannelHTTPCache
+from trytond.modules.prestashop.throttle import TokenBucket, \
+    CircuitBreaker, CircuitOpenError
+from trytond.modules.prestashop.timing import RunReport, collect
 config.set('database', 'path', '/tmp')
 PS_VERSION = '1.6'
 
 
+class StubAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter which answers every request with the same response
+    """
+
+    def __init__(self, status_code, content=''):
+        super(StubAdapter, self).__init__()
+        self.status_code = status_code
+        self.content = content
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.request = request
+        response.url = request.url
+        response._content = self.content
+        return response
+
+    def close(self):
+        pass
+
+
+class SequenceAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter which answers the requests with the given responses
+    in turn. A response is a tuple of the status code, the headers and
+    optionally the content, or an exception to raise.
+    """
+
+    def __init__(self, responses):
+        super(SequenceAdapter, self).__init__()
+        self.responses = list(responses)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        answer = self.responses.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        response = requests.Response()
+        response.status_code, headers = answer[:2]
+        response.headers.update(headers)
+        response.request = request
+        response.url = request.url
+        response._content = answer[2] if len(answer) > 2 else ''
+        return response
+
+    def close(self):
+        pass
+
+
+class PostgresqlBackend(object):
+    """
+    Backend which tells it is postgresql, to run the side transactions of
+    the HTTP cache on the sqlite database of the tests
+    """
+    get = staticmethod(backend.get)
+
+    @staticmethod
+    def name():
+        return 'postgresql'
+
+
+class StubCursor(object):
+    """
+    Cursor which counts the calls made on it
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+    def close(self):
+        self.calls.append('close')
+
+
 def get_objectified_xml(resource, filename):
     """Reads the xml file from the filesystem and returns the objectified xml
 
@@ -496,6 +592,549 @@ class TestPrestashop(BaseTestCase):
 
             txn.cursor.rollback()
 
+    def test_0060_client_registry(self):
+        """Test that the webservice client is reused for a channel until the
+        connection settings of the channel change
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            client = self.channel.get_prestashop_client()
+
+            # Same client is returned for the same channel
+            self.assertTrue(client is self.channel.get_prestashop_client())
+
+            # But not for another channel
+            self.assertFalse(
+                client is self.alt_channel.get_prestashop_client()
+            )
+
+            # Changing the key should give a new client
+            self.SaleChannel.write([self.channel], {
+                'prestashop_key': 'A new key',
+            })
+            new_client = self.channel.get_prestashop_client()
+            self.assertFalse(client is new_client)
+            self.assertEqual(new_client.key, 'A new key')
+            self.assertTrue(new_client is self.channel.get_prestashop_client())
+
+            txn.cursor.rollback()
+
+    def test_0062_session_retry(self):
+        """Test that the session backs off and retries when the site is
+        overloaded or does not answer, as told by Retry-After
+        """
+        limiter = TokenBucket(8, 10)
+        breaker = CircuitBreaker(threshold=4)
+        session = PrestashopSession('A Key', limiter=limiter, breaker=breaker)
+        sleeps = []
+        session.sleep = sleeps.append
+        adapter = SequenceAdapter([
+            (429, {'Retry-After': '7'}),
+            (503, {}),
+            requests.ConnectionError('Connection reset'),
+            (200, {}),
+        ])
+        session.mount('http://', adapter)
+
+        response = session.get('http://shop.example.com/api/orders/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(adapter.requests), 4)
+        # Retry-After is followed, else the backoff doubles every attempt
+        self.assertEqual(sleeps, [7, 2.0, 4.0])
+        self.assertEqual(limiter.get_stats()['throttled'], 2)
+        self.assertAlmostEqual(limiter.rate, 2.8)
+        self.assertEqual(breaker.get_stats()['failures'], 0)
+
+        # The last answer is returned once the retries are used up
+        session.max_retries = 1
+        adapter.responses = [(429, {}), (429, {})]
+        response = session.get('http://shop.example.com/api/orders/1')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(adapter.requests), 6)
+
+        # A request which is not idempotent is never sent twice
+        adapter.responses = [requests.ConnectionError('Connection reset')]
+        self.assertRaises(
+            requests.ConnectionError, session.post,
+            'http://shop.example.com/api/order_histories', data='<x/>'
+        )
+        self.assertEqual(len(adapter.requests), 7)
+
+        # The breaker opens after the failures, no request is sent
+        session.max_retries = 0
+        adapter.responses = [requests.Timeout('No answer')]
+        self.assertRaises(
+            requests.Timeout, session.get,
+            'http://shop.example.com/api/orders/1'
+        )
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(
+            CircuitOpenError, session.get,
+            'http://shop.example.com/api/orders/1'
+        )
+        self.assertEqual(len(adapter.requests), 8)
+
+    def test_0065_client_registry_close(self):
+        """Test that dropped clients are closed, and that the clients of a
+        thread are dropped when the thread ends
+        """
+        registry = ClientRegistry()
+        closed = []
+
+        def get_client(channel_id):
+            client = registry.get(
+                'db', channel_id, 'http://shop.example.com', 'A Key'
+            )
+            client.close = lambda: closed.append(channel_id)
+            return client
+
+        worker = threading.Thread(target=lambda: get_client(1))
+        worker.start()
+        worker.join()
+        self.assertEqual(len(registry._clients), 1)
+
+        # The locals of a thread are dropped a little after join returns
+        for _ in range(100):
+            if registry._ended:
+                break
+            time.sleep(0.01)
+
+        # The client of the thread is closed once it ended
+        get_client(2)
+        self.assertEqual(closed, [1])
+        self.assertEqual(
+            [ident[1] for ident in registry._clients], [2]
+        )
+
+        # Invalidated clients are closed
+        registry.invalidate('db', [2])
+        self.assertEqual(closed, [1, 2])
+        self.assertEqual(registry._clients, {})
+
+    def test_0070_http_cache(self):
+        """Test storing and eviction of cached webservice responses
+        """
+        HTTPCache = POOL.get('prestashop.http.cache')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            self.SaleChannel.write([self.channel], {
+                'prestashop_cache_size': 2,
+            })
+            url = 'http://shop/api/countries/%d'
+
+            self.assertEqual(HTTPCache.lookup(self.channel, url % 1), None)
+
+            HTTPCache.store(self.channel, url % 1, 'FR', etag='"a"')
+            HTTPCache.store(self.channel, url % 2, 'US')
+            HTTPCache.store(self.alt_channel, url % 3, 'IN')
+
+            entry = HTTPCache.lookup(self.channel, url % 1)
+            self.assertEqual(str(entry.content), 'FR')
+            self.assertEqual(entry.etag, '"a"')
+            self.assertTrue(entry.is_fresh(60))
+            self.assertFalse(entry.is_fresh(0))
+
+            # Storing again updates the same entry
+            HTTPCache.store(self.channel, url % 1, 'FR', etag='"b"')
+            self.assertEqual(
+                HTTPCache.lookup(self.channel, url % 1).etag, '"b"'
+            )
+            self.assertEqual(len(HTTPCache.search([
+                ('channel', '=', self.channel.id)
+            ])), 2)
+
+            # The last access time is not updated by a lookup, but by a
+            # touch once it is old enough
+            HTTPCache.write(HTTPCache.search([]), {
+                'last_access': datetime(2000, 1, 1),
+            })
+            entry = HTTPCache.lookup(self.channel, url % 1)
+            self.assertEqual(entry.last_access, datetime(2000, 1, 1))
+            self.assertTrue(entry.needs_touch())
+            HTTPCache.touch([entry])
+            self.assertFalse(
+                HTTPCache.lookup(self.channel, url % 1).needs_touch()
+            )
+
+            # The least recently used entry is dropped when the cache is
+            # full, without touching other channels
+            HTTPCache.store(self.channel, url % 4, 'DE')
+            self.assertEqual(HTTPCache.lookup(self.channel, url % 2), None)
+            self.assertNotEqual(HTTPCache.lookup(self.channel, url % 1), None)
+            self.assertNotEqual(
+                HTTPCache.lookup(self.alt_channel, url % 3), None
+            )
+
+            txn.cursor.rollback()
+
+    def test_0075_http_cache_revalidation(self):
+        """Test that a stale cached response is revalidated with its ETag
+        and used as is when the site did not change it
+        """
+        HTTPCache = POOL.get('prestashop.http.cache')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            self.SaleChannel.write([self.channel], {
+                'prestashop_cache_size': 10,
+                'prestashop_cache_max_age': 0,
+            })
+            session = PrestashopSession(
+                'A Key', cache=ChannelHTTPCache(self.channel.id)
+            )
+            adapter = SequenceAdapter([
+                (200, {'ETag': '"v1"'}, '<countries/>'),
+                (304, {}),
+                (200, {'ETag': '"v2"'}, '<countries>FR</countries>'),
+            ])
+            session.mount('http://', adapter)
+            url = 'http://shop.example.com/api/countries'
+
+            self.assertEqual(session.get(url).content, '<countries/>')
+            entry, = HTTPCache.search([('channel', '=', self.channel.id)])
+            self.assertEqual(entry.etag, '"v1"')
+            fetched_at = entry.fetched_at
+
+            # The response is stale at once, the site is asked if it
+            # changed
+            response = session.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, '<countries/>')
+            self.assertEqual(
+                adapter.requests[1].headers['If-None-Match'], '"v1"'
+            )
+            entry, = HTTPCache.search([('channel', '=', self.channel.id)])
+            self.assertTrue(entry.fetched_at >= fetched_at)
+
+            # A changed response replaces the cached one
+            self.assertEqual(
+                session.get(url).content, '<countries>FR</countries>'
+            )
+            entry, = HTTPCache.search([('channel', '=', self.channel.id)])
+            self.assertEqual(entry.etag, '"v2"')
+            self.assertEqual(len(adapter.requests), 3)
+
+            # A fresh response is used without asking the site
+            self.SaleChannel.write([self.channel], {
+                'prestashop_cache_max_age': 3600,
+            })
+            self.assertEqual(
+                session.get(url).content, '<countries>FR</countries>'
+            )
+            self.assertEqual(len(adapter.requests), 3)
+
+            txn.cursor.rollback()
+
+    def test_0076_http_cache_touch(self):
+        """Test that the last access times of the responses used are
+        written at once when the cache is flushed
+        """
+        HTTPCache = POOL.get('prestashop.http.cache')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            self.SaleChannel.write([self.channel], {
+                'prestashop_cache_size': 10,
+                'prestashop_cache_max_age': 3600,
+            })
+            url = 'http://shop/api/countries/%d'
+            HTTPCache.store(self.channel, url % 1, 'FR')
+            HTTPCache.store(self.channel, url % 2, 'US')
+            HTTPCache.write(HTTPCache.search([]), {
+                'last_access': datetime(2000, 1, 1),
+            })
+            cache = ChannelHTTPCache(self.channel.id)
+
+            # A fresh response is read without any write
+            self.assertEqual(cache.get(url % 1), ('FR', None, None, True))
+            self.assertEqual(cache.get(url % 1), ('FR', None, None, True))
+            self.assertEqual(cache.get(url % 3), None)
+            entry, = HTTPCache.search([('url', '=', url % 1)])
+            self.assertEqual(entry.last_access, datetime(2000, 1, 1))
+
+            cache.flush()
+            entry, other = HTTPCache.search(
+                [], order=[('url', 'ASC')]
+            )
+            self.assertFalse(entry.needs_touch())
+            self.assertEqual(other.last_access, datetime(2000, 1, 1))
+
+            # The sync run of a client flushes its cache
+            registry = ClientRegistry()
+            client = registry.get(
+                DB_NAME, self.channel.id, 'http://shop.example.com',
+                'A Key', cache=cache
+            )
+            registry.start_run(DB_NAME, self.channel.id)
+            self.assertEqual(cache.get(url % 2), ('US', None, None, True))
+            registry.end_run(DB_NAME, self.channel.id)
+            self.assertFalse(other.needs_touch())
+            client.close()
+
+            txn.cursor.rollback()
+
+    def test_0077_http_cache_side_transaction(self):
+        """Test that on postgresql the HTTP cache runs its transactions on
+        one cursor of its own, and that their errors only cost a miss
+        """
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursors = []
+
+        def open_cursor():
+            cursors.append(StubCursor())
+            return cursors[-1]
+
+        def fail(error):
+            raise error
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            cache = ChannelHTTPCache(1)
+            cache.open_cursor = open_cursor
+            cache_module.backend = PostgresqlBackend
+            try:
+                # The transactions of a run share one cursor
+                self.assertEqual(
+                    cache.run(lambda: Transaction().cursor), cursors[0]
+                )
+                self.assertEqual(cache.run(lambda x: x + 1, 1), 2)
+                self.assertEqual(len(cursors), 1)
+                self.assertEqual(cursors[0].calls, ['commit', 'commit'])
+                self.assertEqual(Transaction().cursor, txn.cursor)
+
+                # Database errors are swallowed
+                self.assertEqual(
+                    cache.run(fail, DatabaseIntegrityError()), None
+                )
+                self.assertEqual(
+                    cache.run(fail, UserError('Concurrent update')), None
+                )
+                self.assertEqual(cursors[0].calls[2:], [
+                    'rollback', 'rollback'
+                ])
+
+                # Other errors are raised once the transaction is rolled
+                # back
+                self.assertRaises(
+                    ValueError, cache.run, fail, ValueError()
+                )
+                self.assertEqual(cursors[0].calls[-1], 'rollback')
+                self.assertEqual(Transaction().cursor, txn.cursor)
+
+                # The cursor is released when the cache is closed
+                cache.close()
+                self.assertEqual(cursors[0].calls[-1], 'close')
+                cache.run(lambda: None)
+                self.assertEqual(len(cursors), 2)
+                cache.close()
+            finally:
+                cache_module.backend = backend
+
+    def test_0080_run_cache(self):
+        """Test that identical reads during a sync run share one request
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(ps_test=True):
+                client = self.channel.get_prestashop_client()
+                self.assertEqual(client.run_cache, None)
+
+                with self.channel.prestashop_run():
+                    client = self.channel.get_prestashop_client()
+                    run_cache = client.run_cache
+
+                    customer = client.customers.get(1)
+                    self.assertTrue(customer is client.customers.get(1))
+                    client.fetch_all([('customers', 1), ('addresses', 2)])
+
+                    # A run inside the run shares its cache
+                    with self.channel.prestashop_run():
+                        self.assertTrue(
+                            self.channel.get_prestashop_client().run_cache
+                            is run_cache
+                        )
+
+                    self.assertEqual(run_cache.get_stats(), {
+                        'hits': 2, 'misses': 2, 'hit_ratio': 0.5,
+                    })
+
+                # Cache is dropped at the end of the run
+                self.assertEqual(
+                    self.channel.get_prestashop_client().run_cache, None
+                )
+
+            # Concurrent reads of a record wait for the first one
+            run_cache = RunCache()
+            started, release = threading.Event(), threading.Event()
+            calls = []
+
+            def fetch():
+                calls.append(1)
+                started.set()
+                release.wait()
+                return 'record'
+
+            results = []
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(
+                        run_cache.get(('products', 1), fetch)
+                    )
+                ) for i in range(3)
+            ]
+            threads[0].start()
+            started.wait()
+            for worker in threads[1:]:
+                worker.start()
+            release.set()
+            for worker in threads:
+                worker.join()
+
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results, ['record'] * 3)
+            self.assertEqual(run_cache.get_stats()['misses'], 1)
+
+            # Only the reference records are kept after a page, and the
+            # least recently used of the others are dropped beyond the size
+            run_cache = RunCache(size=2)
+            run_cache.seed(('countries', 8), 'France')
+            run_cache.seed(('customers', 1), 'Customer 1')
+            run_cache.seed(('customers', 2), 'Customer 2')
+            self.assertEqual(run_cache.lookup(('customers', 1)), 'Customer 1')
+            run_cache.seed(('customers', 3), 'Customer 3')
+            self.assertEqual(run_cache.lookup(('customers', 2)), None)
+            self.assertEqual(run_cache.lookup(('customers', 1)), 'Customer 1')
+
+            run_cache.end_page()
+            self.assertEqual(run_cache.lookup(('customers', 1)), None)
+            self.assertEqual(run_cache.lookup(('countries', 8)), 'France')
+
+            txn.cursor.rollback()
+
+    def test_0090_get_many(self):
+        """Test reading many records through lists which fit in the URL
+        """
+        client = PrestashopClient('http://shop.example.com', 'A Key')
+        ids = range(1, 3000)
+        jobs = client._make_chunks(
+            'customers', 'id', ids, ['id', 'email'], {'active': '1'}
+        )
+        self.assertTrue(len(jobs) > 1)
+
+        read_ids = []
+        for resource, display, filters in jobs:
+            url = requests.Request(
+                'GET', client.customers.url,
+                params=client.customers.make_params(
+                    display, filters, None, None, None, None
+                )
+            ).prepare().url
+            self.assertTrue(len(url) <= MAX_URL_LENGTH)
+            self.assertEqual(filters['active'], '1')
+            read_ids.extend(map(int, filters['id'].split('|')))
+        self.assertEqual(read_ids, ids)
+        client.close()
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(ps_test=True):
+                with self.channel.prestashop_run():
+                    client = self.channel.get_prestashop_client()
+
+                    records = client.get_many('addresses', [2, 3, 2])
+                    self.assertEqual(sorted(records.keys()), [2, 3])
+                    self.assertEqual(records[3].id.pyval, 3)
+
+                    # Records read together are in the run cache
+                    self.assertTrue(
+                        client.addresses.get(2) is records[2]
+                    )
+                    records = client.fetch_many([
+                        ('addresses', 3), ('customers', 1)
+                    ])
+                    self.assertTrue(
+                        records[('addresses', 3)] is
+                        client.addresses.get(3)
+                    )
+
+            txn.cursor.rollback()
+
+    def test_0100_order_histories(self):
+        """Test moving orders to a new state through their history
+        """
+        content = (
+            '<prestashop><order_history><id>7</id>'
+            '<id_order>1</id_order><id_order_state>4</id_order_state>'
+            '</order_history></prestashop>'
+        )
+        client = PrestashopClient('http://shop.example.com', 'A Key')
+        adapter = StubAdapter(201, content)
+        client.session.mount('http://', adapter)
+
+        report = RunReport()
+        with collect(report):
+            self.assertEqual(
+                client.add_order_histories([(1, 4), (3, '4')]),
+                [True, True]
+            )
+
+        self.assertEqual(len(adapter.requests), 2)
+        for request in adapter.requests:
+            self.assertEqual(request.method, 'POST')
+            self.assertTrue(request.url.endswith('/api/order_histories'))
+            self.assertTrue('id_order_state' in request.body)
+
+        stats = report.get_report()
+        self.assertEqual(stats['api_calls'], {'order_histories': 2})
+        self.assertEqual(stats['bytes_received'], 2 * len(content))
+        self.assertEqual(
+            stats['bytes_sent'],
+            sum(len(request.body) for request in adapter.requests)
+        )
+
+        # The site refuses them without the permission
+        for status_code in (401, 403, 405):
+            client.session.mount('http://', StubAdapter(status_code))
+            self.assertEqual(client.add_order_histories([(1, 4)]), [False])
+
+        # Only the histories refused are told apart, the requests are sent
+        # in turn to get the responses in order
+        client.max_concurrency = 1
+        client.session.mount('http://', SequenceAdapter([
+            (201, {}, content), (403, {}), (201, {}, content),
+        ]))
+        self.assertEqual(
+            client.add_order_histories([(1, 4), (2, 4), (3, 4)]),
+            [True, False, True]
+        )
+
+        # Other errors are raised, like an overloaded site or an open
+        # circuit
+        client.session.sleep = lambda delay: None
+        client.session.mount('http://', StubAdapter(503))
+        self.assertRaises(
+            PrestaShopWebserviceException,
+            client.add_order_histories, [(1, 4)]
+        )
+        client.session.breaker = CircuitBreaker(threshold=1)
+        client.session.breaker.record_failure()
+        self.assertRaises(
+            CircuitOpenError, client.add_order_histories, [(1, 4)]
+        )
+        client.close()
+
 
 def suite():
     "Prestashop test suite"
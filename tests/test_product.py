@@ -9,6 +9,7 @@ import trytond.tests.test_tryton
 from trytond.transaction import Transaction
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
 
+from trytond.modules.prestashop.timing import RunReport, count_queries
 from test_prestashop import get_objectified_xml, BaseTestCase
 
 
@@ -131,6 +132,66 @@ class TestProduct(BaseTestCase):
                     ('channel', '=', self.alt_channel.id)
                 ])), 0)
 
+    def test_0030_sku_index(self):
+        """Products are found by their SKU in the index of the run
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with txn.set_context(
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                product_data = get_objectified_xml('products', 1)
+                sku = unicode(product_data.reference.pyval)
+
+                # Without a run, the SKU is read from the database
+                self.assertIsNone(self.channel.get_prestashop_sku_index())
+                self.assertEqual(
+                    self.channel.get_prestashop_sku(sku), (None, None)
+                )
+
+                with self.channel.prestashop_run():
+                    self.assertEqual(
+                        self.channel.load_prestashop_skus([sku]),
+                        {sku: (None, None)}
+                    )
+                    product = self.Product.create_from(
+                        self.channel, product_data
+                    )
+                    listing, = self.ChannelListing.search([
+                        ('channel', '=', self.channel.id)
+                    ])
+
+                    # The index is updated as records are created
+                    report = RunReport()
+                    with count_queries(txn.cursor, report):
+                        self.assertEqual(
+                            self.channel.get_prestashop_sku(sku),
+                            (product.id, listing.id)
+                        )
+                        self.assertEqual(
+                            self.Product.create_from(
+                                self.channel, product_data
+                            ),
+                            product
+                        )
+                        self.assertEqual(
+                            self.ChannelListing.create_from(
+                                self.channel, product_data
+                            ),
+                            listing
+                        )
+                    self.assertEqual(report.sql_queries, 0)
+
+                self.assertIsNone(self.channel.get_prestashop_sku_index())
+                self.assertEqual(
+                    self.channel.get_prestashop_sku(sku),
+                    (product.id, listing.id)
+                )
+
 
 def suite():
     "Prestashop Product test suite"
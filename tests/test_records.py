@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    test_records
+
+"""
+import json
+import unittest
+
+import trytond.tests.test_tryton
+
+from trytond.modules.prestashop.records import (
+    singular_name, parse_json_record, parse_json_list
+)
+
+
+ORDER = {
+    'order': {
+        'id': 1,
+        'id_customer': '2',
+        'total_paid': '10.50',
+        'reference': 'XKBKNABJK',
+        'valid': 'true',
+        'associations': {
+            'order_rows': [
+                {'id': '1', 'product_id': '5', 'product_quantity': '2'},
+                {'id': '2', 'product_id': '7', 'product_quantity': '1'},
+            ]
+        }
+    }
+}
+
+COUNTRIES = {
+    'countries': [
+        {
+            'id': 8,
+            'iso_code': 'FR',
+            'name': [
+                {'id': '1', 'value': 'France'},
+                {'id': '2', 'value': 'Frankreich'},
+            ]
+        },
+    ]
+}
+
+
+class TestRecords(unittest.TestCase):
+    "Test the records read from the JSON output of the webservice"
+
+    def test_0010_singular_name(self):
+        """
+        Test the name of a single record of the resources
+        """
+        self.assertEqual(singular_name('countries'), 'country')
+        self.assertEqual(singular_name('addresses'), 'address')
+        self.assertEqual(singular_name('order_rows'), 'order_row')
+
+    def test_0020_record(self):
+        """
+        Test that a record is read like the objectified XML
+        """
+        order = parse_json_record(json.dumps(ORDER))
+
+        self.assertEqual(order.tag, 'order')
+        self.assertEqual(order.id.pyval, 1)
+        self.assertEqual(order.id_customer.pyval, 2)
+        self.assertEqual(order.total_paid.pyval, 10.5)
+        self.assertEqual(order.reference.pyval, 'XKBKNABJK')
+        self.assertEqual(unicode(order.reference), u'XKBKNABJK')
+        self.assertTrue(order.valid.pyval)
+        self.assertEqual(int(order.id_customer), 2)
+        self.assertFalse(hasattr(order, 'id_cart'))
+
+        rows = order.associations.order_rows.getchildren()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0].tag, 'order_row')
+        self.assertEqual(rows[1].product_id.pyval, 7)
+
+    def test_0030_list(self):
+        """
+        Test a list of records and the values in many languages
+        """
+        countries = parse_json_list('countries', json.dumps(COUNTRIES))
+
+        self.assertEqual(len(countries), 1)
+        country, = countries
+        self.assertEqual(country.iso_code.pyval, 'FR')
+
+        names = country.name.getchildren()
+        self.assertEqual(names[0].tag, 'language')
+        self.assertEqual(names[0].get('id'), '1')
+        self.assertEqual(names[1].pyval, 'Frankreich')
+
+        # An empty list is sent as an empty array
+        self.assertEqual(parse_json_list('countries', '[]'), [])
+
+
+def suite():
+    "Prestashop records test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRecords)
+    )
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -3,15 +3,30 @@
     test_sale
 
 """
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime
 from decimal import Decimal
+import threading
 import unittest
 
+import requests
+
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 
-from test_prestashop import get_objectified_xml, BaseTestCase
+from trytond.modules.prestashop import channel as channel_module, \
+    outbox as outbox_module, job as job_module
+from trytond.modules.prestashop.job import has_savepoints, MAX_ATTEMPTS
+from trytond.modules.prestashop.shard import split_in_shards, \
+    run_in_processes, ShardError
+from trytond.modules.prestashop.webservice import MockPrestashopClient
+from trytond.modules.prestashop.throttle import CircuitOpenError
+from test_prestashop import get_objectified_xml, BaseTestCase, \
+    PostgresqlBackend
 
 
 class TestSale(BaseTestCase):
@@ -73,6 +88,11 @@ class TestSale(BaseTestCase):
                     sale.id,
                     self.Sale.get_order_using_ps_data(order_data).id
                 )
+                self.assertEqual(
+                    self.Sale.get_orders_using_ps_data([
+                        order_data, get_objectified_xml('orders', 2)
+                    ]), {order_data.id.pyval: sale}
+                )
 
                 self.assertEqual(sale.state, 'done')
 
@@ -131,6 +151,98 @@ class TestSale(BaseTestCase):
                 # As canceled orders are marked as do not import
                 self.assertEqual(sale.state, 'draft')
 
+    def test_0018_order_import_many(self):
+        """Import orders in different states together
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                delivered_order = get_objectified_xml('orders', 1)
+                canceled_order = get_objectified_xml('orders', 2)
+                paid_order = get_objectified_xml('orders', 1)
+                paid_order.id = 99
+                # Payment accepted
+                paid_order.current_state = 2
+
+                delivered, canceled, paid = \
+                    self.Sale.create_all_using_ps_data([
+                        delivered_order, canceled_order, paid_order
+                    ])
+
+                self.assertEqual(delivered.state, 'done')
+                self.assertEqual(canceled.state, 'draft')
+                self.assertEqual(paid.state, 'processing')
+                self.assertEqual(paid.invoice_method, 'order')
+                self.assertTrue(paid.invoices)
+
+    def test_0019_order_import_workflow_groups(self):
+        """The sales of the same state go through every transition together
+        """
+        calls = []
+
+        def record(name):
+            method = getattr(self.Sale, name)
+
+            def wrapper(cls, *args):
+                calls.append((name, sorted(
+                    int(s.channel_identifier) for s in args[0]
+                )))
+                return method(*args)
+            return classmethod(wrapper)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                delivered_order = get_objectified_xml('orders', 1)
+                paid_orders = []
+                for order_id in (98, 99):
+                    paid_order = get_objectified_xml('orders', 1)
+                    paid_order.id = order_id
+                    # Payment accepted
+                    paid_order.current_state = 2
+                    paid_orders.append(paid_order)
+
+                names = [
+                    'process_group_to_channel_state', 'quote', 'confirm',
+                    'process',
+                ]
+                for name in names:
+                    setattr(self.Sale, name, record(name))
+                try:
+                    delivered, paid_1, paid_2 = \
+                        self.Sale.create_all_using_ps_data(
+                            [delivered_order] + paid_orders
+                        )
+                finally:
+                    for name in names:
+                        delattr(self.Sale, name)
+
+                # One call by state, not by sale
+                self.assertEqual(sorted(calls), [
+                    ('confirm', [98, 99]),
+                    ('process', [98, 99]),
+                    ('process_group_to_channel_state', [1]),
+                    ('process_group_to_channel_state', [98, 99]),
+                    ('quote', [98, 99]),
+                ])
+                self.assertEqual(delivered.state, 'done')
+                self.assertEqual(paid_1.state, 'processing')
+                self.assertEqual(paid_2.state, 'processing')
+
     def test_0020_order_import_from_prestashop(self):
         """Test Order import from prestashop
         """
@@ -154,6 +266,357 @@ class TestSale(BaseTestCase):
                     ('channel', '=', self.channel.id)
                 ])), 1)
 
+                # The next run starts from the last order imported
+                channel = self.SaleChannel(self.channel.id)
+                self.assertEqual(
+                    channel.last_order_import_time,
+                    datetime(2013, 6, 10, 9, 1, 3)
+                )
+
+    def test_0021_order_import_pages(self):
+        """Orders updated during the import are not skipped by the pages
+        """
+        def iter_list(client, resource, display=None, filters=None,
+                      sort=None, limit=None, offset=None, date=None):
+            self.assertEqual(resource, 'orders')
+            self.assertIsNone(offset)
+            requests.append(filters)
+            records = list(orders)
+            for field, value in (filters or {}).iteritems():
+                if field in ('date_upd', 'id'):
+                    low, high = value.split(',')
+                    cast = int if field == 'id' else unicode
+                    records = [
+                        r for r in records if
+                        cast(low) <= cast(unicode(getattr(r, field))) <=
+                        cast(high)
+                    ]
+            for field, _ in reversed(sort):
+                records.sort(key=lambda r: getattr(r, field).pyval)
+            records = records[:limit]
+            if len(requests) == 1:
+                # The first order is updated once its page was read
+                orders[0] = deepcopy(orders[0])
+                orders[0].date_upd = '2013-06-12 08:00:00'
+            return iter(records)
+
+        orders = []
+        for order_id, date_upd in [
+                (1, '2013-06-10 09:01:03'), (2, '2013-06-10 09:01:03'),
+                (3, '2013-06-11 10:00:00'), (4, '2013-06-11 11:00:00')]:
+            order = get_objectified_xml('orders', 1)
+            order.id = order_id
+            order.date_upd = date_upd
+            orders.append(order)
+        requests = []
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+                self.SaleChannel.write([self.channel], {
+                    'last_order_import_time': None,
+                })
+
+                page_size = channel_module.ORDER_PAGE_SIZE
+                channel_module.ORDER_PAGE_SIZE = 2
+                MockPrestashopClient.iter_list = iter_list
+                try:
+                    self.channel.import_orders()
+                finally:
+                    channel_module.ORDER_PAGE_SIZE = page_size
+                    del MockPrestashopClient.iter_list
+
+                # An offset would have skipped the third order, as the first
+                # one moved to the end of the list
+                sales = self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])
+                self.assertEqual(
+                    sorted(int(s.channel_identifier) for s in sales),
+                    [1, 2, 3, 4]
+                )
+                # The pages follow the last order read
+                self.assertEqual(requests[1]['id'], '3,4294967295')
+                self.assertEqual(
+                    requests[1]['date_upd'],
+                    '2013-06-10 09:01:03,2013-06-10 09:01:03'
+                )
+                channel = self.SaleChannel(self.channel.id)
+                self.assertEqual(
+                    channel.last_order_import_time,
+                    datetime(2013, 6, 12, 8, 0, 0)
+                )
+
+    def test_0025_order_import_by_ids(self):
+        """Import orders by their IDs as done by the import processes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                sale, = self.channel.import_prestashop_order_ids([1])
+                self.assertEqual(sale.channel_identifier, '1')
+
+                # An order already imported is not created again
+                self.assertEqual(
+                    self.channel.import_prestashop_order_ids([1]), [sale]
+                )
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 1)
+
+                # Processes are not used in tests
+                self.SaleChannel.write([self.channel], {
+                    'prestashop_import_processes': 4,
+                })
+                self.assertFalse(
+                    self.channel.use_prestashop_import_processes()
+                )
+
+    def test_0026_resolve_references(self):
+        """Records shared by the orders are created before the processes
+        """
+        CurrencyPrestashop = POOL.get('currency.currency.prestashop')
+        CountryPrestashop = POOL.get('country.country.prestashop')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                self.channel.resolve_prestashop_references([1])
+                self.assertTrue(CurrencyPrestashop.search([
+                    ('channel', '=', self.channel.id)
+                ]))
+                self.assertTrue(CountryPrestashop.search([
+                    ('channel', '=', self.channel.id)
+                ]))
+                listings = Listing.search([
+                    ('channel', '=', self.channel.id)
+                ])
+                self.assertTrue(listings)
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 0)
+
+                # The import finds the records
+                sale, = self.channel.import_prestashop_order_ids([1])
+                self.assertEqual(
+                    len(Listing.search([('channel', '=', self.channel.id)])),
+                    len(listings)
+                )
+
+    def test_0027_split_in_shards(self):
+        """Orders of a customer are imported by the same process
+        """
+        order_1 = get_objectified_xml('orders', 1)
+        order_3 = get_objectified_xml('orders', 2)
+        other_order = get_objectified_xml('orders', 1)
+        other_order.id = 5
+        other_order.id_customer = 2
+
+        self.assertEqual(
+            split_in_shards([order_1, order_3, other_order], 2),
+            [[5], [1, 3]]
+        )
+        self.assertEqual(
+            split_in_shards([order_1, order_3, other_order], 1),
+            [[1, 3, 5]]
+        )
+        self.assertEqual(split_in_shards([], 2), [])
+
+    def test_0027_run_in_processes(self):
+        """Functions are run in new worker processes
+        """
+        self.assertEqual(
+            run_in_processes(2, len, [[1, 2], [3], 'abcd']), [2, 1, 4]
+        )
+        # The error of a process is raised in the current one
+        self.assertRaises(ShardError, run_in_processes, 2, int, ['1', 'x'])
+
+    def test_0028_order_import_job_retry(self):
+        """Failed orders are imported again after a growing delay
+        """
+        ImportJob = POOL.get('prestashop.import.job')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                ImportJob.register_failure(
+                    self.channel, 'orders', 1, UserError('Unknown country')
+                )
+                job, = ImportJob.search([])
+                self.assertEqual(job.status, 'failed')
+                self.assertEqual(job.attempts, 1)
+                self.assertEqual(job.last_error, 'Unknown country')
+                exception, = ChannelException.search([
+                    ('channel', '=', self.channel.id)
+                ])
+                self.assertIn('orders 1 ', exception.log)
+
+                # The next attempt is not due yet
+                self.assertEqual(ImportJob.claim(self.channel, 'orders'), [])
+                self.assertEqual(
+                    self.channel.process_prestashop_import_jobs(), []
+                )
+
+                ImportJob.register_failure(
+                    self.channel, 'orders', 1, 'Again'
+                )
+                job, = ImportJob.search([])
+                self.assertEqual(job.attempts, 2)
+                self.assertEqual(
+                    ImportJob.get_delay(2), 2 * ImportJob.get_delay(1)
+                )
+                self.assertEqual(
+                    ImportJob.get_delay(30), ImportJob.get_delay(40)
+                )
+
+                job.next_attempt = datetime.utcnow()
+                job.save()
+
+                sale, = self.channel.process_prestashop_import_jobs()
+                self.assertEqual(sale.channel_identifier, '1')
+                job, = ImportJob.search([])
+                self.assertEqual(job.status, 'done')
+                self.assertTrue(job.finished_at >= job.started_at)
+
+    def test_0028_order_import_site_error(self):
+        """Errors of the site stop the import instead of failing the orders
+        """
+        ImportJob = POOL.get('prestashop.import.job')
+
+        @contextmanager
+        def savepoint(name):
+            yield
+
+        def create_all_using_ps_data(order_records, order_rows=None):
+            raise errors.pop(0)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+                order = get_objectified_xml('orders', 1)
+
+                patched = [
+                    (channel_module, 'savepoint', savepoint),
+                    (channel_module, 'has_savepoints', lambda: True),
+                    (
+                        self.Sale, 'create_all_using_ps_data',
+                        staticmethod(create_all_using_ps_data)
+                    ),
+                ]
+                originals = [
+                    (obj, name, obj.__dict__.get(name))
+                    for obj, name, _ in patched
+                ]
+                for obj, name, value in patched:
+                    setattr(obj, name, value)
+                try:
+                    errors = [CircuitOpenError('Open')]
+                    self.assertRaises(
+                        CircuitOpenError,
+                        self.channel.create_prestashop_orders,
+                        [order], [None]
+                    )
+                    self.assertEqual(ImportJob.search([]), [])
+
+                    errors = [
+                        ValueError('Batch'), requests.Timeout('Timeout')
+                    ]
+                    self.assertRaises(
+                        requests.Timeout,
+                        self.channel.create_prestashop_orders,
+                        [order], [None]
+                    )
+                    self.assertEqual(ImportJob.search([]), [])
+
+                    # An error of the order fails the order only
+                    errors = [ValueError('Batch'), ValueError('Order')]
+                    self.assertEqual(
+                        self.channel.create_prestashop_orders(
+                            [order], [None]
+                        ), {}
+                    )
+                    job, = ImportJob.search([])
+                    self.assertEqual(job.remote_id, 1)
+                    self.assertEqual(job.status, 'failed')
+                finally:
+                    for obj, name, value in originals:
+                        if value is None:
+                            delattr(obj, name)
+                        else:
+                            setattr(obj, name, value)
+
+    def test_0029_order_import_queue(self):
+        """Orders are listed in a queue and imported by the workers
+        """
+        ImportJob = POOL.get('prestashop.import.job')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                start = datetime.utcnow().replace(microsecond=0)
+                job, = self.channel.enqueue_prestashop_orders()
+                self.assertEqual(job.status, 'pending')
+                self.assertEqual(job.resource, 'orders')
+                self.assertEqual(job.remote_id, 1)
+                channel = self.SaleChannel(self.channel.id)
+                self.assertTrue(channel.last_order_import_time >= start)
+
+                # Listing again does not add a job
+                self.channel.enqueue_prestashop_orders()
+                self.assertEqual(len(ImportJob.search([])), 1)
+
+                ImportJob.process_jobs_using_cron()
+                job, = ImportJob.search([])
+                self.assertEqual(job.status, 'done')
+                self.assertEqual(len(self.Sale.search([
+                    ('channel', '=', self.channel.id)
+                ])), 1)
+
+                # Nothing is left to claim
+                self.assertEqual(ImportJob.claim(self.channel, 'orders'), [])
+
     def test_0030_check_prestashop_exception_order_total(self):
         """
         Check if exception is created when order total does not match
@@ -188,6 +651,569 @@ class TestSale(BaseTestCase):
 
                 self.assertNotEqual(sale.state, 'done')
 
+    def test_0035_order_import_prefetch(self):
+        """
+        Check that the records prefetched for a page of orders are all the
+        records needed to import them, and that they are not looked for
+        again for every order
+        """
+        prefetched = []
+
+        def prefetch_prestashop_records(channel, **kwargs):
+            prefetched.append(kwargs)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_data = get_objectified_xml('orders', 1)
+
+                with self.channel.prestashop_run():
+                    client = self.channel.get_prestashop_client()
+                    self.channel.prefetch_prestashop_orders([order_data])
+                    misses = client.run_cache.get_stats()['misses']
+
+                    sale = self.Sale.find_or_create_using_ps_data(order_data)
+
+                    # No record was read one by one while importing
+                    self.assertEqual(
+                        client.run_cache.get_stats()['misses'], misses
+                    )
+                    self.assertEqual(sale.state, 'done')
+
+                    self.SaleChannel.prefetch_prestashop_records = \
+                        prefetch_prestashop_records
+                    try:
+                        self.Sale.get_sale_data_using_ps_data(order_data)
+                        self.assertEqual(prefetched, [])
+
+                        # Once the page ended, the records of an order are
+                        # prefetched with it
+                        self.channel.end_prestashop_page()
+                        self.Sale.get_sale_data_using_ps_data(order_data)
+                        self.assertEqual(len(prefetched), 1)
+                    finally:
+                        del self.SaleChannel.prefetch_prestashop_records
+
+    def test_0037_order_import_embedded_rows(self):
+        """
+        Import an order whose rows have the data of their lines, without
+        reading their order details
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_data = get_objectified_xml('orders', 1)
+                order_rows = order_data.associations.order_rows.getchildren()
+                self.assertFalse(SaleLine.has_ps_line_data(order_rows[0]))
+
+                # Rows of recent versions of prestashop have the price
+                for order_row in order_rows:
+                    order_row.unit_price_tax_excl = get_objectified_xml(
+                        'order_details', order_row.id.pyval
+                    ).unit_price_tax_excl.pyval
+                self.assertTrue(SaleLine.has_ps_line_data(order_rows[0]))
+
+                with self.channel.prestashop_run():
+                    client = self.channel.get_prestashop_client()
+                    sale = self.Sale.find_or_create_using_ps_data(order_data)
+
+                    self.assertFalse([
+                        key for key in client.run_cache.records
+                        if key[0] == 'order_details'
+                    ])
+
+                self.assertEqual(
+                    sale.total_amount,
+                    Decimal(str(order_data.total_paid_tax_excl))
+                )
+
+    def test_0040_order_import_with_projected_fields(self):
+        """
+        Import an order read with a list of fields, whose rows come from the
+        order details
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                self.assertTrue(
+                    'id_customer' in self.Sale.get_ps_order_fields()
+                )
+
+                order_data = get_objectified_xml('orders', 1)
+                # Lists read with a display of fields have no associations
+                order_data.remove(order_data.associations)
+                order_rows = [
+                    get_objectified_xml('order_details', 1),
+                    get_objectified_xml('order_details', 2),
+                ]
+
+                sale = self.Sale.find_or_create_using_ps_data(
+                    order_data, order_rows
+                )
+
+                self.assertEqual(sale.state, 'done')
+                self.assertEqual(
+                    sale.total_amount,
+                    Decimal(str(order_data.total_paid_tax_excl))
+                )
+
+    def test_0045_export_order_status_unchanged(self):
+        """The state of an order is not sent when prestashop has it already
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_data = get_objectified_xml('orders', 1)
+                sale = self.Sale.create_using_ps_data(order_data)
+                self.assertEqual(
+                    sale.last_prestashop_state,
+                    unicode(order_data.current_state.pyval)
+                )
+
+                state_map = self.channel.get_prestashop_state_map()
+                self.assertEqual(set(state_map), set(['cancel', 'done']))
+                target_state = sale.get_prestashop_target_state()
+                self.assertEqual(target_state, state_map['done'])
+                sale.set_last_prestashop_state(target_state)
+
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.last_prestashop_state, target_state)
+
+                # No request is sent, the mock site would refuse it
+                self.assertIsNone(sale.export_order_status_to_prestashop())
+                self.assertIsNone(
+                    sale.export_order_status_to_prestashop(state_map)
+                )
+
+    def test_0045_export_order_status_refused(self):
+        """Only the orders whose history was refused are sent back
+        """
+        histories, sent_back = [], []
+
+        def add_order_histories(client, items):
+            histories.extend(items)
+            return [True, False]
+
+        def export_order_status_to_prestashop(sale, state_map=None):
+            sent_back.append(sale)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order_1 = get_objectified_xml('orders', 1)
+                order_2 = get_objectified_xml('orders', 1)
+                order_2.id = 99
+                sale_1, sale_2 = self.Sale.create_all_using_ps_data([
+                    order_1, order_2
+                ])
+                target_state = sale_1.get_prestashop_target_state()
+                self.assertNotEqual(
+                    target_state, sale_1.last_prestashop_state
+                )
+
+                MockPrestashopClient.add_order_histories = add_order_histories
+                self.Sale.export_order_status_to_prestashop = \
+                    export_order_status_to_prestashop
+                try:
+                    self.assertEqual(
+                        self.channel.export_prestashop_order_states([
+                            sale_1, sale_2
+                        ]), [sale_1, sale_2]
+                    )
+                finally:
+                    del MockPrestashopClient.add_order_histories
+                    del self.Sale.export_order_status_to_prestashop
+
+                self.assertEqual(histories, [
+                    ('1', target_state), ('99', target_state)
+                ])
+                self.assertEqual(sent_back, [sale_2])
+                self.assertEqual(
+                    self.Sale(sale_1.id).last_prestashop_state, target_state
+                )
+
+    def test_0045_export_order_status_not_listed_again(self):
+        """The sales whose state was sent are not listed by the next export
+        """
+        histories = []
+
+        def add_order_histories(client, items):
+            histories.extend(items)
+            return [True] * len(items)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                sale = self.Sale.create_using_ps_data(
+                    get_objectified_xml('orders', 1)
+                )
+                target_state = sale.get_prestashop_target_state()
+
+                MockPrestashopClient.add_order_histories = add_order_histories
+                try:
+                    self.assertEqual(
+                        self.channel.export_orders_to_prestashop(), [sale]
+                    )
+                finally:
+                    del MockPrestashopClient.add_order_histories
+
+                self.assertEqual(histories, [('1', target_state)])
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.last_prestashop_state, target_state)
+
+                channel = self.SaleChannel(self.channel.id)
+                self.assertTrue(
+                    channel.last_order_export_time >= sale.write_date
+                )
+                self.assertEqual(self.Sale.get_ps_changed_sale_ids(
+                    channel, channel.last_order_export_time
+                ), [])
+
+    def test_0046_order_state_outbox(self):
+        """The states of sales are sent through the outbox
+        """
+        Outbox = POOL.get('prestashop.order.outbox')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order = get_objectified_xml('orders', 1)
+                # Preparation in progress
+                order.current_state = 3
+                sale = self.Sale.create_using_ps_data(order)
+                self.assertEqual(sale.state, 'processing')
+                self.assertEqual(Outbox.search([]), [])
+
+                self.Sale.do([sale])
+                row, = Outbox.search([])
+                self.assertEqual(row.sale, sale)
+                self.assertEqual(row.channel, self.channel)
+
+                # A sale which the transition skips is not added
+                self.Sale.do([sale])
+                self.assertEqual(Outbox.search([]), [row])
+
+                # Failed rows are sent again later
+                Outbox.register_failure([row], 'Site unavailable')
+                row = Outbox(row.id)
+                self.assertEqual(row.attempts, 1)
+                self.assertEqual(row.last_error, 'Site unavailable')
+                self.assertEqual(Outbox.claim(), [])
+                self.assertEqual(Outbox.drain(), 0)
+
+                # Every transition adds a row, which is only inserted
+                other_row, = Outbox.enqueue([sale, sale])
+                self.assertNotEqual(other_row, row)
+                self.assertEqual(
+                    set(Outbox.search([])), set([row, other_row])
+                )
+                self.assertEqual(Outbox(row.id).attempts, 1)
+
+                # The rows of a sale are sent once, and only the rows
+                # claimed are deleted
+                sent, added = [], []
+                export = self.SaleChannel.export_prestashop_order_states
+
+                def export_prestashop_order_states(channel, sales):
+                    sent.append(sales)
+                    added.extend(Outbox.enqueue(sales))
+                    return export(channel, sales)
+
+                sale = self.Sale(sale.id)
+                sale.set_last_prestashop_state(
+                    sale.get_prestashop_target_state()
+                )
+                Outbox.write([row], {'next_attempt': datetime.utcnow()})
+                self.SaleChannel.export_prestashop_order_states = \
+                    export_prestashop_order_states
+                try:
+                    self.assertEqual(Outbox.drain(), 2)
+                finally:
+                    del self.SaleChannel.export_prestashop_order_states
+                self.assertEqual(sent, [[sale]])
+                self.assertEqual(Outbox.search([]), added)
+
+                # The mock site has the state already, nothing is sent
+                self.assertEqual(Outbox.drain(), 1)
+                self.assertEqual(Outbox.search([]), [])
+
+    def test_0046_order_state_outbox_failure(self):
+        """A channel which fails is rolled back to its savepoint
+        """
+        Outbox = POOL.get('prestashop.order.outbox')
+        ChannelException = POOL.get('channel.exception')
+        savepoints = []
+
+        @contextmanager
+        def savepoint(name):
+            savepoints.append(name)
+            yield
+
+        def send(channel, sales):
+            raise ValueError('Database error')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order = get_objectified_xml('orders', 1)
+                sale = self.Sale.create_using_ps_data(order)
+                row, = Outbox.enqueue([sale])
+
+                outbox_module.has_savepoints = lambda: True
+                outbox_module.savepoint = savepoint
+                Outbox.send = staticmethod(send)
+                try:
+                    self.assertEqual(Outbox.drain(), 1)
+                    self.assertEqual(savepoints, ['prestashop_outbox'])
+                    row = Outbox(row.id)
+                    self.assertEqual(row.attempts, 1)
+                    self.assertEqual(row.last_error, 'Database error')
+
+                    # A row which failed too many times is dropped and
+                    # reported on its sale
+                    Outbox.write([row], {
+                        'attempts': MAX_ATTEMPTS - 1,
+                        'next_attempt': datetime.utcnow(),
+                    })
+                    self.assertEqual(Outbox.drain(), 1)
+                finally:
+                    outbox_module.has_savepoints = has_savepoints
+                    outbox_module.savepoint = job_module.savepoint
+                    del Outbox.send
+
+                self.assertEqual(Outbox.search([]), [])
+                exception, = ChannelException.search([
+                    ('origin', '=', 'sale.sale,%s' % sale.id),
+                ])
+                self.assertEqual(exception.channel, self.channel)
+                self.assertIn('Database error', exception.log)
+
+    def test_0047_changed_sales(self):
+        """Sales to export are found by their write date or their moves
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                order = get_objectified_xml('orders', 1)
+                # Preparation in progress
+                order.current_state = 3
+                sale = self.Sale.create_using_ps_data(order)
+                self.assertEqual(sale.state, 'processing')
+                self.assertTrue(sale.shipments)
+
+                self.assertEqual(
+                    self.Sale.get_ps_changed_sale_ids(self.channel),
+                    [sale.id]
+                )
+                self.assertEqual(self.Sale.get_ps_changed_sale_ids(
+                    self.channel, datetime(2000, 1, 1)
+                ), [sale.id])
+                self.assertEqual(self.Sale.get_ps_changed_sale_ids(
+                    self.channel, datetime(2100, 1, 1)
+                ), [])
+                self.assertEqual(self.Sale.get_ps_changed_sale_ids(
+                    self.alt_channel, datetime(2000, 1, 1)
+                ), [])
+
+                # Only the moves of the sale changed since then
+                table = self.Sale.__table__()
+                txn.cursor.execute(*table.update(
+                    [table.write_date], [datetime(2000, 1, 1)],
+                    where=table.id == sale.id
+                ))
+                self.assertEqual(self.Sale.get_ps_changed_sale_ids(
+                    self.channel, datetime(2010, 1, 1)
+                ), [sale.id])
+
+    def test_0048_export_cron_stats(self):
+        """The export cron keeps the duration of the export of every channel
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+                self.assertTrue(
+                    self.SaleChannel.lock_prestashop_channel(self.channel.id)
+                )
+
+                stats = self.channel.get_prestashop_export_stats()
+                runs = stats['runs'] if stats else 0
+
+                self.SaleChannel.export_orders_to_prestashop_using_cron()
+
+                stats = self.channel.get_prestashop_export_stats()
+                self.assertEqual(stats['runs'], runs + 1)
+                self.assertEqual(stats['last_status'], 'done')
+                self.assertTrue(
+                    stats['max_seconds'] >= stats['last_seconds'] >= 0
+                )
+
+    def test_0049_export_cron_threads(self):
+        """On postgresql the export cron exports every channel once, from
+        threads of its own
+        """
+        calls = []
+
+        def export_channel_orders(cls, args):
+            calls.append((args, threading.current_thread()))
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+            channels = self.SaleChannel.search([
+                ('source', '=', 'prestashop')
+            ])
+
+            channel_module.backend = PostgresqlBackend
+            self.SaleChannel.export_channel_orders = \
+                classmethod(export_channel_orders)
+            try:
+                self.SaleChannel.export_orders_to_prestashop_using_cron()
+            finally:
+                channel_module.backend = backend
+                del self.SaleChannel.export_channel_orders
+
+        self.assertTrue(channels)
+        self.assertEqual(
+            sorted(args[3] for args, _ in calls),
+            sorted(channel.id for channel in channels)
+        )
+        for (database_name, user, _, _), worker in calls:
+            self.assertEqual(database_name, DB_NAME)
+            self.assertEqual(user, USER)
+            self.assertNotEqual(worker, threading.current_thread())
+
+    def test_0049_export_channel_lock(self):
+        """A channel locked by another transaction is not exported
+        """
+        exported = []
+
+        def export_orders_to_prestashop(channel):
+            exported.append(channel.id)
+
+        self.SaleChannel.lock_prestashop_channel = staticmethod(
+            lambda channel_id: channel_id != 2
+        )
+        self.SaleChannel.export_orders_to_prestashop = \
+            export_orders_to_prestashop
+        try:
+            for channel_id in (1, 2):
+                self.SaleChannel.export_channel_orders(
+                    (DB_NAME, USER, {}, channel_id)
+                )
+        finally:
+            del self.SaleChannel.lock_prestashop_channel
+            del self.SaleChannel.export_orders_to_prestashop
+
+        self.assertEqual(exported, [1])
+        self.assertEqual(
+            channel_module.export_timings.get_stats(
+                (DB_NAME, 1)
+            )['last_status'], 'done'
+        )
+        self.assertEqual(
+            channel_module.export_timings.get_stats(
+                (DB_NAME, 2)
+            )['last_status'], 'skipped'
+        )
+
+    def test_0050_order_import_dry_run(self):
+        """Import orders in a dry run and check the report
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            # Call method to setup defaults
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                self.User.get_preferences(context_only=True),
+                current_channel=self.channel.id, ps_test=True,
+            ):
+                self.setup_channels()
+
+                report = self.channel.dry_run_import_orders()
+
+                self.assertEqual(report['orders'], 1)
+                self.assertTrue(report['orders_per_second'] > 0)
+                for name in (
+                    'parse', 'party', 'product', 'create', 'workflow',
+                    'other'
+                ):
+                    self.assertIn(name, report['stages'])
+                self.assertTrue(report['sql_queries'] > 0)
+
+                # Everything was rolled back
+                self.assertEqual(self.Sale.search([]), [])
+
 
 def suite():
     "Prestashop Sale test suite"
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    test_throttle
+
+"""
+import unittest
+
+import trytond.tests.test_tryton
+
+from trytond.modules.prestashop.throttle import (
+    TokenBucket, CircuitBreaker, CircuitOpenError
+)
+
+
+class FakeClock(object):
+    "A clock which only moves when asked to"
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestThrottle(unittest.TestCase):
+    "Test rate limiting and circuit breaking of requests"
+
+    def test_0010_token_bucket(self):
+        """Test that requests are paced after the burst is used
+        """
+        clock = FakeClock()
+        bucket = TokenBucket(2, 3, clock=clock, sleep=clock.sleep)
+
+        # The burst goes through without waiting
+        for i in range(3):
+            bucket.acquire()
+        self.assertEqual(clock.now, 1000.0)
+
+        # Then requests are sent at the rate
+        bucket.acquire()
+        self.assertEqual(clock.now, 1000.5)
+        bucket.acquire()
+        self.assertEqual(clock.now, 1001.0)
+
+        stats = bucket.get_stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['waited'], 1.0)
+
+    def test_0020_token_bucket_adapts(self):
+        """Test that the rate is lowered when the site is overloaded and
+        comes back with successful requests
+        """
+        bucket = TokenBucket(10, 10)
+
+        bucket.slow_down()
+        bucket.slow_down()
+        self.assertEqual(bucket.rate, 2.5)
+        self.assertEqual(bucket.get_stats()['throttled'], 2)
+
+        for i in range(20):
+            bucket.speed_up()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_0030_disabled_token_bucket(self):
+        """Test that a limiter without rate never waits
+        """
+        clock = FakeClock()
+        bucket = TokenBucket(0, 1, clock=clock, sleep=clock.sleep)
+        for i in range(10):
+            bucket.acquire()
+        self.assertEqual(clock.now, 1000.0)
+
+    def test_0040_circuit_breaker(self):
+        """Test that the circuit opens after consecutive failures and is
+        tried again after the timeout
+        """
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=3, reset_timeout=60, clock=clock)
+
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before_request()
+
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+        clock.sleep(60)
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.before_request()
+
+        # Failure of the trial request opens the circuit again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+        clock.sleep(60)
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.get_stats()['trips'], 1)
+
+    def test_0050_circuit_breaker_trial(self):
+        """Test that a half open circuit lets a single trial request through
+        """
+        clock = FakeClock()
+        breaker = CircuitBreaker(threshold=1, reset_timeout=60, clock=clock)
+
+        breaker.record_failure()
+        clock.sleep(60)
+        breaker.before_request()
+        # Other requests wait for the outcome of the trial
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+        # A trial which never tells its outcome is replaced
+        clock.sleep(60)
+        breaker.before_request()
+        clock.sleep(30)
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+        clock.sleep(30)
+        breaker.before_request()
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before_request()
+        breaker.before_request()
+
+
+def suite():
+    "Prestashop throttle test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestThrottle)
+    )
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
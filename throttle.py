@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    throttle
+
+    Rate limiting and circuit breaking of the requests sent to a prestashop
+    site.
+
+"""
+import time
+import threading
+
+from pystashop import PrestaShopWebserviceException
+
+__all__ = ['TokenBucket', 'CircuitBreaker', 'CircuitOpenError']
+
+
+class CircuitOpenError(PrestaShopWebserviceException):
+    """
+    Raised when requests are not sent because the site seems to be down
+    """
+    pass
+
+
+class TokenBucket(object):
+    """
+    Adaptive token bucket rate limiter
+
+    Tokens are added at `rate` tokens per second up to `burst` tokens and
+    every request takes one. When the site signals that it is overloaded the
+    rate is halved and it then grows back to the configured rate with every
+    successful request.
+    """
+
+    #: The rate never goes below this many requests per second
+    min_rate = 0.1
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        """
+        :param rate: Number of requests allowed per second. A false value
+                     disables the limiter.
+        :param burst: Number of requests which can be sent at once
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst or 1, 1)
+        self.tokens = float(self.burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Take a token, waiting for one to be available if needed
+        """
+        with self.lock:
+            self.requests += 1
+            if not self.rate:
+                return
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+
+        if wait:
+            self.sleep(wait)
+
+    def slow_down(self):
+        """
+        The site asked to slow down, halve the rate
+        """
+        with self.lock:
+            self.throttled += 1
+            if self.rate:
+                self.rate = max(self.rate / 2.0, self.min_rate)
+
+    def speed_up(self):
+        """
+        A request went through, move the rate back towards the maximum
+        """
+        if self.rate == self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate / 10.0, self.max_rate)
+
+    def get_stats(self):
+        """
+        Return the statistics of the limiter as a dictionary
+        """
+        return {
+            'max_rate': self.max_rate,
+            'rate': self.rate,
+            'burst': self.burst,
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'waited': self.waited,
+        }
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for the requests to a site
+
+    After `threshold` consecutive failures the circuit opens and requests
+    fail right away with `CircuitOpenError`. Once `reset_timeout` seconds
+    have gone by, one trial request is let through while the others keep
+    failing; the circuit closes again if it succeeds. A trial request which
+    never reports its outcome is replaced by another one after
+    `reset_timeout` seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_request(self):
+        """
+        Raise `CircuitOpenError` if the circuit is open, or if it is half
+        open and the trial request was let through already
+        """
+        with self.lock:
+            state = self.state
+            if state == 'half-open':
+                now = self.clock()
+                if self.trial_started_at is None or \
+                        now - self.trial_started_at >= self.reset_timeout:
+                    self.trial_started_at = now
+                    return
+                state = 'open'
+        if state == 'open':
+            raise CircuitOpenError(
+                'Prestashop site is not responding, requests are suspended '
+                'for %d seconds' % self.reset_timeout
+            )
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_started_at = None
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                # Also restarts the timeout of a half open circuit
+                self.opened_at = self.clock()
+
+    def get_stats(self):
+        """
+        Return the statistics of the breaker as a dictionary
+        """
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+        }
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+    timing
+
+    Measure of the time spent in the stages of a sync run.
+
+"""
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+__all__ = [
+    'RunReport', 'get_report', 'collect', 'bind', 'stage',
+    'count_api_call', 'count_traffic', 'count_queries', 'RunTimings',
+]
+
+_local = threading.local()
+
+
+class RunReport(object):
+    """
+    Time spent in every stage of a sync run, number of requests sent to the
+    site with the bytes they sent and received, and number of queries sent
+    to the database
+
+    The time of a stage does not include the time of the stages run inside
+    it. Stages run in the threads which send concurrent requests are
+    counted in full, so the sum of the stages can exceed the duration of the
+    run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.api_calls = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.sql_queries = 0
+        self.orders = 0
+        self.started = time.time()
+        self.finished = None
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def add_api_call(self, resource):
+        with self.lock:
+            self.api_calls[resource] = self.api_calls.get(resource, 0) + 1
+
+    def add_traffic(self, sent, received):
+        with self.lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def add_query(self):
+        self.sql_queries += 1
+
+    def finish(self, orders):
+        """
+        End the measure
+
+        :param orders: Number of orders synced
+        """
+        self.finished = time.time()
+        self.orders = orders
+
+    def get_report(self):
+        """
+        Return the measures as a dictionary
+        """
+        seconds = (self.finished or time.time()) - self.started
+        return {
+            'orders': self.orders,
+            'seconds': round(seconds, 3),
+            'orders_per_second': round(
+                self.orders / seconds if seconds else 0, 2
+            ),
+            'stages': dict(
+                (name, round(value, 3))
+                for name, value in self.stages.iteritems()
+            ),
+            'api_calls': dict(self.api_calls),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'sql_queries': self.sql_queries,
+        }
+
+
+def get_report():
+    """
+    Return the report collected by the current thread, or None
+    """
+    return getattr(_local, 'report', None)
+
+
+@contextmanager
+def collect(report):
+    """
+    Collect the measures of the current thread in the report
+
+    :param report: Instance of `RunReport`
+    """
+    previous = get_report()
+    _local.report, _local.stack = report, []
+    try:
+        yield report
+    finally:
+        _local.report, _local.stack = previous, []
+
+
+def bind(func):
+    """
+    Return func collecting its measures in the report of the current thread,
+    to be called from another thread
+    """
+    report = get_report()
+    if report is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with collect(report):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def stage(name):
+    """
+    Count the time spent in the block in the stage, if the measures of the
+    current thread are collected
+
+    :param name: Name of the stage, eg: 'http'
+    """
+    report = get_report()
+    if report is None:
+        yield
+        return
+
+    stack = _local.stack
+    now = time.time()
+    if stack:
+        # The enclosing stage is paused
+        parent, resumed = stack[-1]
+        report.add_time(parent, now - resumed)
+    stack.append((name, now))
+    try:
+        yield
+    finally:
+        now = time.time()
+        name, resumed = stack.pop()
+        report.add_time(name, now - resumed)
+        if stack:
+            stack[-1] = (stack[-1][0], now)
+
+
+def count_api_call(resource):
+    """
+    Count a request sent for the resource
+    """
+    report = get_report()
+    if report is not None:
+        report.add_api_call(resource)
+
+
+def count_traffic(sent, received):
+    """
+    Count the bytes of the body of a request and of its response
+    """
+    report = get_report()
+    if report is not None:
+        report.add_traffic(sent, received)
+
+
+@contextmanager
+def count_queries(cursor, report):
+    """
+    Count the queries sent through the cursor in the report
+
+    :param cursor: Cursor of the transaction
+    :param report: Instance of `RunReport`
+    """
+    execute = cursor.execute
+
+    def counted_execute(*args, **kwargs):
+        report.add_query()
+        return execute(*args, **kwargs)
+
+    cursor.execute = counted_execute
+    try:
+        yield
+    finally:
+        del cursor.execute
+
+
+class RunTimings(object):
+    """
+    Duration and outcome of the runs of every channel in this process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, key, status, seconds):
+        """
+        Record a run
+
+        :param key: Hashable key of the channel, eg: (database name, ID)
+        :param status: 'done', 'skipped' or 'failed'
+        :param seconds: Duration of the run
+        """
+        with self.lock:
+            stats = self.stats.setdefault(key, {
+                'runs': 0, 'done': 0, 'skipped': 0, 'failed': 0,
+                'last_status': None, 'last_seconds': None,
+                'max_seconds': 0.0, 'total_seconds': 0.0,
+            })
+            stats['runs'] += 1
+            stats[status] += 1
+            stats['last_status'] = status
+            stats['last_seconds'] = round(seconds, 3)
+            stats['max_seconds'] = max(
+                stats['max_seconds'], stats['last_seconds']
+            )
+            stats['total_seconds'] += seconds
+
+    def get_stats(self, key):
+        """
+        Return the statistics of the runs of the channel, or None if it did
+        not run
+        """
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                return None
+            stats = dict(stats)
+        stats['average_seconds'] = round(
+            stats['total_seconds'] / stats['runs'], 3
+        )
+        stats['total_seconds'] = round(stats['total_seconds'], 3)
+        return stats
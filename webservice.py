@@ -0,0 +1,1148 @@
+# -*- coding: utf-8 -*-
+"""
+    webservice
+
+    Client layer used to talk to the prestashop webservice.
+
+"""
+import time
+import thread
+import weakref
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from urllib import urlencode
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from lxml import etree, objectify
+import pystashop
+from mockstashop import MockstaShopWebservice
+
+from throttle import TokenBucket, CircuitBreaker
+from records import parse_json_record, parse_json_list
+from timing import bind, stage, count_api_call, count_traffic
+
+__all__ = [
+    'PrestashopSession', 'PrestashopClient', 'MockPrestashopClient',
+    'ClientRegistry', 'RunCache', 'make_display',
+]
+
+#: Default number of connections kept alive per channel
+DEFAULT_POOL_SIZE = 10
+
+#: Default number of requests sent at the same time to a channel
+DEFAULT_MAX_CONCURRENCY = 4
+
+#: Default number of requests per second and burst allowed for a channel
+DEFAULT_RATE_LIMIT = 10.0
+DEFAULT_BURST = 20
+
+#: Seconds to wait for the site to answer
+DEFAULT_TIMEOUT = 60
+
+#: Longest URL sent to a site. Many servers refuse request lines longer
+#: than 4 or 8 KB, so this stays well below.
+MAX_URL_LENGTH = 2000
+
+#: Response codes by which the site asks to slow down
+RETRY_STATUS_CODES = (429, 503)
+
+#: Status codes of the site refusing a request the webservice key is not
+#: allowed to send
+REFUSED_STATUS_CODES = (401, 403, 405)
+
+#: Methods which can be sent again if the response never came
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+#: Resources which rarely change, and whose responses are cached
+CACHEABLE_RESOURCES = (
+    'countries', 'states', 'currencies', 'languages', 'order_states',
+    'products', 'combinations',
+)
+
+#: Resources whose records are kept by a sync run until its end. The
+#: records of the other resources are dropped after every page of orders.
+REFERENCE_RESOURCES = (
+    'countries', 'states', 'currencies', 'languages', 'order_states',
+)
+
+#: Number of records of the other resources kept by a sync run, the least
+#: recently used are dropped beyond
+RUN_CACHE_SIZE = 5000
+
+
+def make_display(fields):
+    """
+    Return the value of the display parameter of a list which reads the
+    given fields of the records
+
+    :param fields: List of field names, or None to read the full records
+    """
+    if fields is None:
+        return 'full'
+    return sorted(set(fields) | set(['id']))
+
+
+class PrestashopSession(requests.Session):
+    """
+    A requests session tuned for the prestashop webservice
+
+    Connections are pooled and kept alive across requests and responses are
+    asked to be compressed, so that a sync run reuses a handful of
+    connections instead of opening a new one for every record.
+    """
+
+    #: Number of times a request is retried before giving up
+    max_retries = 4
+
+    #: Seconds to wait before the first retry, doubled on every retry
+    backoff_factor = 1.0
+
+    #: Function which waits between two attempts
+    sleep = staticmethod(time.sleep)
+
+    def __init__(
+        self, key, pool_size=None, limiter=None, breaker=None, cache=None
+    ):
+        """
+        :param key: The webservice key used for authentication
+        :param pool_size: Number of connections to keep in the pool
+        :param limiter: `TokenBucket` which paces the requests
+        :param breaker: `CircuitBreaker` which stops the requests when the
+                        site is down
+        :param cache: Cache of the responses of the resources which rarely
+                      change. See `cache.ChannelHTTPCache`.
+        """
+        super(PrestashopSession, self).__init__()
+        pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.limiter = limiter
+        self.breaker = breaker
+        self.cache = cache
+
+        self.auth = (key, 'ignore')
+        self.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def get_backoff(self, attempt, response=None):
+        """
+        Return the seconds to wait before sending the request again
+        """
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return int(retry_after)
+        return self.backoff_factor * (2 ** attempt)
+
+    @staticmethod
+    def get_resource(url):
+        """
+        Return the name of the resource the url points to
+        """
+        path = urlparse(url).path
+        if '/api/' not in path:
+            return None
+        return path.split('/api/', 1)[1].split('/', 1)[0]
+
+    @staticmethod
+    def build_cached_response(url, content):
+        """
+        Build a response for the content served from the cache
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = content
+        return response
+
+    def request(self, method, url, **kwargs):
+        """
+        Send the request. GET requests of the resources which rarely change
+        are served from the cache when possible.
+        """
+        if method.upper() != 'GET' or self.cache is None or \
+                not self.cache.available or \
+                self.get_resource(url) not in CACHEABLE_RESOURCES:
+            return self.send_request(method, url, **kwargs)
+
+        full_url = requests.Request(
+            method, url, params=kwargs.get('params')
+        ).prepare().url
+        cached = self.cache.get(full_url)
+        if cached is None:
+            response = self.send_request(method, url, **kwargs)
+            if response.status_code == 200:
+                self.cache.set(
+                    full_url, response.content,
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'),
+                )
+            return response
+
+        content, etag, last_modified, fresh = cached
+        if fresh:
+            return self.build_cached_response(full_url, content)
+
+        # Ask the site if the cached content is still good
+        headers = dict(kwargs.pop('headers', None) or {})
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = self.send_request(method, url, headers=headers, **kwargs)
+
+        if response.status_code == 304:
+            self.cache.revalidated(full_url)
+            return self.build_cached_response(full_url, content)
+        if response.status_code == 200:
+            self.cache.set(
+                full_url, response.content,
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified'),
+            )
+        return response
+
+    def send_request(self, method, url, **kwargs):
+        """
+        Send the request, pacing it with the limiter and retrying with an
+        exponential backoff when the site is overloaded or does not answer
+        """
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+
+        attempt = 0
+        while True:
+            last_attempt = attempt >= self.max_retries
+            self.before_send()
+            count_api_call(self.get_resource(url))
+            try:
+                with stage('http'):
+                    response = super(PrestashopSession, self).request(
+                        method, url, **kwargs
+                    )
+            except (requests.Timeout, requests.ConnectionError):
+                self.record_failure()
+                if last_attempt or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                self.sleep(self.get_backoff(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                self.record_success(response, kwargs.get('stream'))
+                return response
+
+            self.record_failure(overloaded=True)
+            if last_attempt:
+                return response
+            # Release the connection of a streamed response
+            response.close()
+            self.sleep(self.get_backoff(attempt, response))
+            attempt += 1
+
+    def before_send(self):
+        """
+        Wait for the limiter to let the request go, and raise
+        `CircuitOpenError` if the site is not to be asked
+        """
+        if self.breaker is not None:
+            self.breaker.before_request()
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def record_failure(self, overloaded=False):
+        """
+        Tell the breaker that the site did not answer, and the limiter that
+        it asked to slow down if overloaded
+        """
+        if overloaded and self.limiter is not None:
+            self.limiter.slow_down()
+        if self.breaker is not None:
+            self.breaker.record_failure()
+
+    def record_success(self, response, stream=False):
+        """
+        Tell the breaker and the limiter that the site answered, and count
+        the bytes of the request and of its response
+        """
+        if self.breaker is not None:
+            self.breaker.record_success()
+        if self.limiter is not None:
+            self.limiter.speed_up()
+        count_traffic(
+            len(response.request.body or ''),
+            self.get_received_bytes(response, stream)
+        )
+
+    @staticmethod
+    def get_received_bytes(response, stream=False):
+        """
+        Return the number of bytes of the body of the response, as sent on
+        the wire when known. The body of a streamed response is not read
+        yet, so only its announced length is known.
+        """
+        if stream:
+            length = response.headers.get('Content-Length', '')
+            return int(length) if length.isdigit() else 0
+        if response.raw is not None and hasattr(response.raw, 'tell'):
+            return response.raw.tell()
+        return len(response.content)
+
+
+class RunCache(object):
+    """
+    Records read from the site during a sync run
+
+    Identical reads of a record share one request: the first caller sends
+    it while the others wait for its result, and the record is then served
+    from memory. The number of hits tells how many round-trips were saved.
+
+    The records of the `REFERENCE_RESOURCES` are kept for the whole run.
+    The other records, like customers and addresses, are kept until the
+    end of the page of orders being imported, see `end_page`, and at most
+    `size` of them are kept so that the memory used by a run does not grow
+    with the number of orders.
+
+    The run also keeps the tryton product and listing of the SKUs met, see
+    `sale.channel.get_prestashop_sku`.
+    """
+
+    def __init__(self, size=RUN_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.reference_records = {}
+        self.records = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        #: IDs of the product and of the listing by SKU
+        self.skus = {}
+        #: IDs of the orders of the page whose records were prefetched
+        self.prefetched_orders = set()
+
+    def _get_record(self, key):
+        """
+        Return the cached record for the key or None, marking it as
+        recently used. Called with the lock held.
+        """
+        if key[0] in REFERENCE_RESOURCES:
+            return self.reference_records.get(key)
+        record = self.records.pop(key, None)
+        if record is not None:
+            self.records[key] = record
+        return record
+
+    def _set_record(self, key, record):
+        """
+        Cache the record, dropping the least recently used records beyond
+        the size of the cache. Called with the lock held.
+        """
+        if key[0] in REFERENCE_RESOURCES:
+            self.reference_records[key] = record
+            return
+        self.records.pop(key, None)
+        self.records[key] = record
+        while len(self.records) > self.size:
+            self.records.popitem(last=False)
+
+    def get(self, key, fetch):
+        """
+        Return the record for the key, calling `fetch` only if the record
+        is neither cached nor being read by another thread
+
+        :param key: Hashable key of the record, eg: ('customers', 1)
+        :param fetch: Callable which reads the record from the site
+        """
+        with self.lock:
+            record = self._get_record(key)
+            if record is not None:
+                self.hits += 1
+                return record
+            event = self.in_flight.get(key)
+            if event is None:
+                self.misses += 1
+                event = self.in_flight[key] = threading.Event()
+                owner = True
+            else:
+                self.hits += 1
+                owner = False
+
+        if not owner:
+            event.wait()
+            with self.lock:
+                record = self._get_record(key)
+            if record is not None:
+                return record
+            # The request of the other thread failed, the error is raised
+            # by sending it again
+            return fetch()
+
+        try:
+            record = fetch()
+            with self.lock:
+                self._set_record(key, record)
+            return record
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def lookup(self, key):
+        """
+        Return the cached record for the key or None
+        """
+        with self.lock:
+            record = self._get_record(key)
+            if record is not None:
+                self.hits += 1
+            return record
+
+    def seed(self, key, record):
+        """
+        Add a record read by some other request, like a list, to the cache
+        """
+        with self.lock:
+            if self._get_record(key) is None:
+                self._set_record(key, record)
+
+    def end_page(self):
+        """
+        Drop the records read for the page of orders which was imported,
+        and keep the records of the reference resources
+        """
+        with self.lock:
+            self.records.clear()
+            self.prefetched_orders.clear()
+
+    def mark_prefetched(self, order_ids):
+        """
+        Remember that the records needed by the orders of the page were
+        prefetched, see `sale.channel.prefetch_prestashop_orders`
+        """
+        with self.lock:
+            self.prefetched_orders.update(order_ids)
+
+    def is_prefetched(self, order_id):
+        """
+        Check if the records needed by the order were prefetched with its
+        page
+        """
+        with self.lock:
+            return order_id in self.prefetched_orders
+
+    def get_stats(self):
+        """
+        Return the hits, misses and hit ratio of the cache
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': total and float(self.hits) / total or 0.0,
+        }
+
+
+class RunCacheResourceMixin(object):
+    """
+    Resource proxy which reads single records through the run cache of the
+    client
+    """
+    #: `RunCache` of the client
+    run_cache = None
+
+    @classmethod
+    def get(cls, id):
+        return cls.run_cache.get(
+            (cls.__resource__, int(id)),
+            lambda: super(RunCacheResourceMixin, cls).get(id)
+        )
+
+
+class JSONResourceMixin(object):
+    """
+    Resource proxy which reads records from the JSON output of the
+    webservice instead of the XML one
+    """
+
+    @classmethod
+    def get(cls, id):
+        """
+        Reads a single record from the server
+
+        :param id: Id of the record to read
+        """
+        response = cls.session.get(
+            '%s/%d' % (cls.url, id), params={'output_format': 'JSON'}
+        )
+        cls.check_status(response)
+        return parse_json_record(response.content)
+
+    @classmethod
+    def get_list(cls, as_ids=False, display=None,
+                 filters=None, sort=None, limit=None, offset=None, date=None):
+        """
+        Gets a list of records by sending GET on the Collection
+        URI of the resource. See `pystashop.api.ResourceProxy.get_list`.
+        """
+        if display is None:
+            display = []
+
+        if as_ids and 'id' not in display and display != 'full':
+            display.append('id')
+
+        params = cls.make_params(display, filters, sort, limit, offset, date)
+        params['output_format'] = 'JSON'
+        response = cls.session.get(cls.url, params=params)
+        cls.check_status(response)
+        records = parse_json_list(cls.__resource__, response.content)
+
+        if as_ids:
+            return map(lambda r: int(r.id), records)
+        return records
+
+
+class ClientMixin(object):
+    """
+    Helpers shared by the real and the mock webservice clients
+    """
+    #: Format in which the records are read, XML or JSON. Records are
+    #: always written as XML.
+    output_format = 'XML'
+
+    #: Number of requests this client sends at the same time
+    max_concurrency = DEFAULT_MAX_CONCURRENCY
+
+    #: Semaphore shared by all the clients of a channel, which bounds the
+    #: number of requests sent to the site at the same time
+    semaphore = None
+
+    _thread_pool = None
+
+    #: `RunCache` of the sync run the client is used in, if any
+    run_cache = None
+
+    def __getattr__(self, name):
+        """
+        Return a Resource proxy object for the attribute, which reads the
+        records in the output format of the client and through the run
+        cache
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        proxy = super(ClientMixin, self).__getattr__(name)
+        bases, attrs = [proxy], {}
+        if self.output_format == 'JSON':
+            bases.insert(0, JSONResourceMixin)
+        if self.run_cache is not None:
+            bases.insert(0, RunCacheResourceMixin)
+            attrs['run_cache'] = self.run_cache
+        if len(bases) == 1:
+            return proxy
+        return type(proxy.__name__, tuple(bases), attrs)
+
+    def get_xml_resource(self, name):
+        """
+        Return a Resource proxy object which reads the records as
+        objectified XML whatever the output format of the client. Use it for
+        records which are updated and sent back to the site.
+
+        :param name: Name of the resource
+        """
+        return super(ClientMixin, self).__getattr__(name)
+
+    def _map(self, func, items):
+        """
+        Call func on every item, concurrently if the client allows it
+        """
+        def timed(item):
+            # Reading the records, less the time spent waiting for the site
+            with stage('parse'):
+                return func(item)
+
+        if len(items) < 2 or self.max_concurrency < 2:
+            return map(timed, items)
+
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPool(self.max_concurrency)
+        return self._thread_pool.map(bind(timed), items)
+
+    def _fetch(self, call):
+        resource, id = call
+        if self.semaphore is None:
+            return getattr(self, resource).get(id)
+        with self.semaphore:
+            return getattr(self, resource).get(id)
+
+    def fetch_all(self, calls):
+        """
+        Fetch the given records concurrently
+
+        :param calls: A list of tuples of resource name and record ID
+                      eg: [('customers', 1), ('addresses', 4)]
+        :returns: A dictionary of the (resource, ID) tuple to the record
+        """
+        calls = list(set(calls))
+        return dict(zip(calls, self._map(self._fetch, calls)))
+
+    def _get_proxy(self, resource):
+        if isinstance(resource, basestring):
+            return getattr(self, resource)
+        return resource
+
+    def _make_chunks(self, resource, key, values, display, filters=None):
+        """
+        Split the values into lists which fit in the URL of a request
+        filtering the resource on the key
+
+        :returns: A list of tuples of resource, display, filters to use for
+                  every request
+        """
+        proxy = self._get_proxy(resource)
+        filters = dict(filters or {})
+        filters[key] = ''
+        params = proxy.make_params(display, filters, None, None, None, None)
+        if self.output_format == 'JSON':
+            params['output_format'] = 'JSON'
+        # Every value takes its own length plus the url encoded separator
+        limit = budget = MAX_URL_LENGTH - (
+            len(proxy.url) + 1 + len(urlencode(params))
+        )
+
+        chunks, chunk = [], []
+        for value in values:
+            size = len(str(value)) + 3
+            if chunk and size > budget:
+                chunks.append(chunk)
+                chunk, budget = [], limit
+            chunk.append(str(value))
+            budget -= size
+        if chunk:
+            chunks.append(chunk)
+
+        return [
+            (resource, display, dict(filters, **{key: '|'.join(chunk_values)}))
+            for chunk_values in chunks
+        ]
+
+    def _get_chunk(self, job):
+        resource, display, filters = job
+        proxy = self._get_proxy(resource)
+        if self.semaphore is None:
+            return proxy.get_list(display=display, filters=filters)
+        with self.semaphore:
+            return proxy.get_list(display=display, filters=filters)
+
+    def get_list_in(self, resource, key, values, fields=None, filters=None):
+        """
+        Read the records of the resource whose key is one of the values.
+        The values are split in as many requests as needed to keep the URLs
+        short enough for the server, and the requests are sent concurrently.
+
+        :param resource: Name of the resource or a resource proxy
+        :param key: Name of the field to filter on, eg: 'id_product'
+        :param values: List of values of the field
+        :param fields: List of fields to read, all of them if None
+        :param filters: A dictionary of other filters
+        :returns: A list of records
+        """
+        values = sorted(set(values))
+        if not values:
+            return []
+
+        display = make_display(fields)
+        jobs = self._make_chunks(resource, key, values, display, filters)
+        return sum(self._map(self._get_chunk, jobs), [])
+
+    def fetch_many(self, calls, fields=None):
+        """
+        Fetch the given records with as few requests as possible. Like
+        `fetch_all` but the records of a resource are read together through
+        a list filtered on their IDs.
+
+        :param calls: A list of tuples of resource name and record ID
+                      eg: [('customers', 1), ('addresses', 4)]
+        :param fields: List of fields to read, all of them if None. Partial
+                       records are not added to the run cache.
+        :returns: A dictionary of the (resource, ID) tuple to the record
+        """
+        result, ids_by_resource = {}, {}
+        for resource, id in set(calls):
+            id = int(id)
+            record = None
+            if self.run_cache is not None and fields is None:
+                record = self.run_cache.lookup((resource, id))
+            if record is not None:
+                result[(resource, id)] = record
+            else:
+                ids_by_resource.setdefault(resource, []).append(id)
+
+        display = make_display(fields)
+        jobs = []
+        for resource, ids in ids_by_resource.iteritems():
+            jobs.extend(
+                self._make_chunks(resource, 'id', sorted(ids), display)
+            )
+
+        for (resource, _, _), records in zip(
+                jobs, self._map(self._get_chunk, jobs)):
+            for record in records:
+                result[(resource, int(record.id))] = record
+                if self.run_cache is not None and fields is None:
+                    self.run_cache.seed((resource, int(record.id)), record)
+
+        # Records missing from the lists are read one by one, which raises
+        # the error of the site if they do not exist
+        missing = [
+            (resource, record_id)
+            for resource, ids in ids_by_resource.iteritems()
+            for record_id in ids if (resource, record_id) not in result
+        ]
+        if missing:
+            result.update(self.fetch_all(missing))
+        return result
+
+    def get_many(self, resource, ids, fields=None):
+        """
+        Fetch the records of the resource with the given IDs. See
+        `fetch_many`.
+
+        :param resource: Name of the resource
+        :param ids: List of record IDs
+        :param fields: List of fields to read, all of them if None
+        :returns: A dictionary of the ID to the record
+        """
+        records = self.fetch_many(
+            [(resource, id) for id in ids], fields=fields
+        )
+        return dict((id, record) for (_, id), record in records.iteritems())
+
+    def _add_order_history(self, history):
+        order_id, state = history
+        order_history = objectify.Element('order_history')
+        order_history.id_order = int(order_id)
+        order_history.id_order_state = int(state)
+
+        proxy = self.get_xml_resource('order_histories')
+        data = {
+            'xml': etree.tostring(proxy.wrap_in_prestashop_tag(order_history))
+        }
+        if self.semaphore is None:
+            response = proxy.session.post(proxy.url, data=data)
+        else:
+            with self.semaphore:
+                response = proxy.session.post(proxy.url, data=data)
+        if response.status_code in REFUSED_STATUS_CODES:
+            return False
+        proxy.check_status(response)
+        return True
+
+    def add_order_histories(self, histories):
+        """
+        Move orders to new states by adding a record to their history, which
+        is much smaller than sending the whole order back and leaves the
+        other fields of the order alone. The webservice creates one record
+        per request, so the requests are sent concurrently.
+
+        :param histories: List of tuples of order ID and state code
+        :returns: List telling for every history whether the site took it.
+                  The site refuses them if the webservice key is not allowed
+                  to add order histories. Other errors are raised.
+        """
+        return self._map(self._add_order_history, histories)
+
+    def _open_list(self, proxy, params):
+        """
+        Send the request for a list and return a file like object to read
+        the body of the response as it arrives
+        """
+        if self.semaphore is None:
+            response = proxy.session.get(proxy.url, params=params, stream=True)
+        else:
+            with self.semaphore:
+                response = proxy.session.get(
+                    proxy.url, params=params, stream=True
+                )
+        proxy.check_status(response)
+        if response.raw is None:
+            # Response served from the cache
+            return BytesIO(response.content)
+        response.raw.decode_content = True
+        return response.raw
+
+    def iter_list(self, resource, display=None, filters=None, sort=None,
+                  limit=None, offset=None, date=None):
+        """
+        Read a list of records, yielding the records one at a time while
+        the response is parsed. Unlike `get_list`, the whole list is never
+        held in memory, so use it for lists which can be large, like the
+        orders to import. The records are always read as XML.
+
+        See `pystashop.api.ResourceProxy.get_list` for the parameters.
+        """
+        proxy = self.get_xml_resource(resource)
+        params = proxy.make_params(
+            display or [], filters, sort, limit, offset, date
+        )
+        stream = self._open_list(proxy, params)
+        try:
+            records = self._parse_list(stream, resource)
+            while True:
+                # Only the parse is timed, not the work done on every
+                # record by the caller
+                with stage('parse'):
+                    record = next(records, None)
+                if record is None:
+                    return
+                yield record
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _parse_list(stream, resource):
+        """
+        Yield the records of the resource as they are parsed from the
+        stream
+        """
+        for _, element in etree.iterparse(stream, events=('end',)):
+            parent = element.getparent()
+            if parent is None or parent.tag != resource:
+                continue
+            record = objectify.fromstring(etree.tostring(element))
+            # Drop the parsed record and the ones before it from the tree
+            # being built
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+            yield record
+
+    def end_run(self):
+        """
+        Called when the sync run the client is used in ends
+        """
+        pass
+
+    def close(self):
+        """
+        Release the threads and connections held by this client
+        """
+        if self._thread_pool is not None:
+            self._thread_pool.terminate()
+            self._thread_pool = None
+
+
+class PrestashopClient(ClientMixin, pystashop.PrestaShopWebservice):
+    """
+    Prestashop webservice client which uses a pooled session
+    """
+
+    def __init__(
+        self, url, key, pool_size=None, limiter=None, breaker=None,
+        cache=None, debug=False
+    ):
+        """
+        :param url: The store's root path
+        :param key: The webservice key
+        :param pool_size: Number of connections to keep in the pool
+        :param limiter: `TokenBucket` which paces the requests
+        :param breaker: `CircuitBreaker` for the site
+        :param cache: Cache of the responses of the resources which rarely
+                      change
+        :param debug: A Boolean indicating whether the Web service must use
+                      its debug mode
+        """
+        super(PrestashopClient, self).__init__(url, key, debug)
+        self._session = PrestashopSession(
+            key, pool_size, limiter, breaker, cache
+        )
+
+    @property
+    def session(self):
+        return self._session
+
+    def end_run(self):
+        """
+        Write the last access times kept by the cache of the responses and
+        release its cursor
+        """
+        cache = self._session.cache
+        if cache is not None:
+            cache.flush()
+            cache.close()
+
+    def close(self):
+        """
+        Release the threads and connections held by this client
+        """
+        super(PrestashopClient, self).close()
+        self._session.close()
+        if self._session.cache is not None:
+            self._session.cache.close()
+
+
+class MockPrestashopClient(ClientMixin, MockstaShopWebservice):
+    """
+    Mock webservice client used by the tests
+    """
+
+    def _open_list(self, proxy, params):
+        # The session of the mock site cannot stream
+        response = proxy.session.get(proxy.url, params=params)
+        proxy.check_status(response)
+        return BytesIO(response.content)
+
+    def _get_chunk(self, job):
+        resource, display, filters = job
+        if filters.keys() == ['id']:
+            # The mock site ignores the filters of a list, so records are
+            # read one by one
+            proxy = self._get_proxy(resource)
+            return [
+                proxy.get(int(id)) for id in filters['id'].split('|')
+            ]
+        return super(MockPrestashopClient, self)._get_chunk(job)
+
+
+class ChannelState(object):
+    """
+    State shared by all the clients of a channel in this process
+    """
+
+    def __init__(self, max_concurrency, rate_limit, burst):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.limiter = TokenBucket(rate_limit, burst)
+        self.breaker = CircuitBreaker()
+
+    def get_stats(self):
+        """
+        Return the statistics of the limiter and the circuit breaker
+        """
+        return {
+            'limiter': self.limiter.get_stats(),
+            'breaker': self.breaker.get_stats(),
+        }
+
+
+class ThreadWatch(object):
+    """
+    Object kept by a thread in a thread local, and dropped with the other
+    locals of the thread when it ends
+    """
+
+
+class ClientRegistry(object):
+    """
+    Registry of webservice clients
+
+    A client is kept for every database, channel and worker thread. The
+    settings with which a client was built are stored along with it, and the
+    client is rebuilt when the settings on the channel change.
+
+    The clients and runs of a thread are closed and dropped once the thread
+    ended, the next time the registry is used.
+
+    The limits on the requests sent to a channel are shared by all the
+    clients of the channel.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._states = {}
+        self._runs = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._watches = {}
+        self._ended = []
+
+    def _watch_thread(self):
+        """
+        Get told when the current thread ends. Called with the lock held.
+        """
+        if getattr(self._local, 'watch', None) is not None:
+            return
+        ident = thread.get_ident()
+        ended = self._ended
+        watch = self._local.watch = ThreadWatch()
+        self._watches[ident] = weakref.ref(
+            watch, lambda ref: ended.append(ident)
+        )
+
+    def _drop_ended_threads(self):
+        """
+        Drop the clients and runs of the threads which ended. Called with
+        the lock held.
+
+        :returns: The list of clients dropped, to be closed once the lock
+                  is released
+        """
+        clients = []
+        while self._ended:
+            ident = self._ended.pop()
+            watch = self._watches.get(ident)
+            if watch is not None and watch() is not None:
+                # The ident was given to a new thread already
+                continue
+            self._watches.pop(ident, None)
+            for key in self._clients.keys():
+                if key[2] == ident:
+                    clients.append(self._clients.pop(key)[1])
+            for key in self._runs.keys():
+                if key[2] == ident:
+                    del self._runs[key]
+        return clients
+
+    def get(
+        self, database_name, channel_id, url, key, pool_size=None,
+        max_concurrency=None, rate_limit=None, burst=None, cache=None,
+        output_format=None
+    ):
+        """
+        Return the client for the channel in the current thread
+
+        :param database_name: Name of the database the channel belongs to
+        :param channel_id: ID of the channel
+        :param url: URL of the prestashop site
+        :param key: Webservice key of the prestashop site
+        :param pool_size: Number of connections to keep in the pool
+        :param max_concurrency: Number of requests which can be sent to the
+                                site at the same time
+        :param rate_limit: Number of requests allowed per second
+        :param burst: Number of requests which can be sent at once
+        :param cache: Cache of the responses used by a new client
+        :param output_format: Format in which the records are read
+        :returns: Instance of `PrestashopClient`
+        """
+        ident = (database_name, channel_id, thread.get_ident())
+        settings = (
+            url, key, pool_size, max_concurrency, rate_limit, burst,
+            output_format
+        )
+
+        with self._lock:
+            ended_clients = self._drop_ended_threads()
+            entry = self._clients.get(ident)
+        for ended_client in ended_clients:
+            ended_client.close()
+        if entry and entry[0] == settings:
+            return entry[1]
+
+        max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+        limits = (max_concurrency, rate_limit, burst)
+        with self._lock:
+            state = self._states.get((database_name, channel_id))
+            if state is None or state[0] != limits:
+                state = (limits, ChannelState(*limits))
+                self._states[(database_name, channel_id)] = state
+            state = state[1]
+
+            client = PrestashopClient(
+                url, key, pool_size, state.limiter, state.breaker, cache
+            )
+            client.max_concurrency = max_concurrency
+            client.output_format = output_format or 'XML'
+            client.semaphore = state.semaphore
+            self._clients[ident] = (settings, client)
+            self._watch_thread()
+
+        if entry:
+            # Settings changed, the old client cannot be used anymore
+            entry[1].close()
+        return client
+
+    def get_stats(self, database_name, channel_id):
+        """
+        Return the statistics of the requests sent to the channel from this
+        process
+
+        :param database_name: Name of the database
+        :param channel_id: ID of the channel
+        :returns: A dictionary of statistics or None if no request was sent
+        """
+        state = self._states.get((database_name, channel_id))
+        return state and state[1].get_stats() or None
+
+    def start_run(self, database_name, channel_id):
+        """
+        Start a sync run of the channel in the current thread
+
+        :param database_name: Name of the database
+        :param channel_id: ID of the channel
+        :returns: A tuple of the `RunCache` of the run and whether the run
+                  was started by this call. A run started inside another
+                  run shares its cache.
+        """
+        ident = (database_name, channel_id, thread.get_ident())
+        with self._lock:
+            if ident in self._runs:
+                return self._runs[ident], False
+            run_cache = self._runs[ident] = RunCache()
+            self._watch_thread()
+        return run_cache, True
+
+    def get_run_cache(self, database_name, channel_id):
+        """
+        Return the `RunCache` of the current sync run of the channel in the
+        current thread, or None
+        """
+        return self._runs.get(
+            (database_name, channel_id, thread.get_ident())
+        )
+
+    def end_run(self, database_name, channel_id):
+        """
+        End the sync run of the channel in the current thread
+
+        :returns: The `RunCache` of the run
+        """
+        ident = (database_name, channel_id, thread.get_ident())
+        with self._lock:
+            run_cache = self._runs.pop(ident, None)
+            entry = self._clients.get(ident)
+        if entry is not None:
+            entry[1].end_run()
+        return run_cache
+
+    def reset(self):
+        """
+        Forget all the clients and runs without closing them
+
+        Used in a forked process, whose connections are shared with the
+        parent process and must be left to it.
+        """
+        self._clients = {}
+        self._states = {}
+        self._runs = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._watches = {}
+        self._ended = []
+
+    def invalidate(self, database_name, channel_ids=None):
+        """
+        Drop and close the clients of the given channels
+
+        :param database_name: Name of the database
+        :param channel_ids: List of channel IDs. If None, clients of all the
+                            channels of the database are dropped.
+        """
+        clients = []
+        with self._lock:
+            clients.extend(self._drop_ended_threads())
+            for ident in self._clients.keys():
+                if ident[0] != database_name:
+                    continue
+                if channel_ids is None or ident[1] in channel_ids:
+                    clients.append(self._clients.pop(ident)[1])
+        for client in clients:
+            client.close()
+
+
+#: Clients shared by all the channels of this process
+client_registry = ClientRegistry()